@@ -0,0 +1,84 @@
+import importlib
+import multiprocessing
+import os
+import subprocess
+
+import joblib
+import pandas as pd
+
+from common import get_path, import_metrics, initialize
+from generate_data import generate_data, parse_arguments
+
+initialize(get_path("benchmark"))
+STAGES = {
+    "preprocess_data": None,
+    "process_data": {"n_jobs": -1, "return_as": "generator"},
+    "postprocess_data": None,
+    "measure_features": {"n_jobs": -1, "prefer": "threads"},
+    "measure_indicators": None,
+}
+
+
+def run_stage(stage, project):
+    function = getattr(importlib.import_module(stage), stage)
+    initialize(get_path("benchmark"))
+    if STAGES[stage] is None:
+        function(project)
+    else:
+        with joblib.Parallel(**STAGES[stage]) as parallel:
+            function([project], parallel)
+
+
+def benchmark_stages(project):
+    context = multiprocessing.get_context("spawn")
+    for stage in STAGES:
+        print(f"{project}: Benchmarking stage {stage}")
+        (process := context.Process(target=run_stage, args=(stage, project))).start()
+        process.join()
+        if process.exitcode:
+            raise RuntimeError(f"Stage {stage} failed with exit code {process.exitcode}")
+
+
+def export_benchmark(benchmark):
+    file = get_path("benchmarks")
+    benchmark.to_csv(file, header=not file.exists(), index=False, mode="a")
+
+
+def main():
+    args = parse_arguments()
+    label = subprocess.run(
+        ["git", "describe", "--always", "--dirty"], capture_output=True, text=True, cwd=os.path.dirname(__file__)
+    ).stdout.strip()
+    run = os.environ["RUN_ID"] = f"benchmark-{pd.Timestamp.now().strftime('%Y%m%d%H%M%S')}"
+    print(f"Generating data for project {args.project}")
+    generate_data(**vars(args))
+    benchmark_stages(args.project)
+    metrics = import_metrics().query("run == @run")
+    benchmark = pd.DataFrame(
+        {
+            "run": run,
+            "label": label,
+            **vars(args),
+            "stage": metrics["stage"],
+            "rows_in": metrics["rows_in"],
+            "rows_out": metrics["rows_out"],
+            "wall_time": metrics["wall_time"],
+            "throughput": metrics["rows_in"] / metrics["wall_time"],
+            "max_rss": metrics["max_rss"],
+            "log_time": metrics["log_time"],
+        }
+    )
+    print(
+        benchmark[["stage", "rows_in", "rows_out", "wall_time", "throughput", "max_rss", "log_time"]].to_string(
+            index=False
+        )
+    )
+    export_benchmark(benchmark)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("Stop benchmarking data")
+        exit(1)
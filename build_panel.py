@@ -0,0 +1,84 @@
+import os
+
+import joblib
+import pandas as pd
+
+from common import (
+    force_refresh,
+    get_logger,
+    get_path,
+    indicated,
+    initialize,
+    instrument,
+    read_csv,
+    record_rows,
+)
+
+initialize()
+PANELS = ["features_fixed", "indicators"]
+
+
+def outdated(project):
+    return any(
+        not (partition := get_path(f"{file}_panel", project)).exists()
+        or partition.stat().st_mtime < get_path(file, project).stat().st_mtime
+        for file in PANELS
+    )
+
+
+def remove_partitions(projects):
+    partitions = {get_path(f"{file}_panel", project) for file in PANELS for project in projects}
+    removed = [
+        partition
+        for file in PANELS
+        for partition in (get_path("panel") / file).glob("*.parquet")
+        if partition not in partitions
+    ]
+    for partition in removed:
+        partition.unlink()
+    return removed
+
+
+@instrument
+def build_partition(project):
+    logger = get_logger(__file__)
+    logger.info(f"{project}: Building panel partitions")
+    for file in PANELS:
+        panel = read_csv(file, project)
+        panel = panel.astype({column: "string" for column in panel.select_dtypes("category").columns})
+        partition = get_path(f"{file}_panel", project)
+        panel.to_parquet(partial := partition.with_suffix(".partial"), index=False)
+        os.replace(partial, partition)
+        record_rows(rows_in=len(panel), rows_out=len(panel))
+
+
+def export_panel(file, projects):
+    panel = get_path(f"{file}_panel_csv")
+    with open(partial := panel.with_suffix(".partial"), "w") as output:
+        for index, project in enumerate(projects):
+            pd.read_parquet(get_path(f"{file}_panel", project)).to_csv(output, header=index == 0, index=False)
+    os.replace(partial, panel)
+
+
+def main():
+    projects = indicated()
+    for file in PANELS:
+        (get_path("panel") / file).mkdir(parents=True, exist_ok=True)
+    removed = remove_partitions(projects)
+    changed = [project for project in projects if force_refresh() or outdated(project)]
+    with joblib.Parallel(n_jobs=-1, verbose=1) as parallel:
+        parallel(joblib.delayed(build_partition)(project) for project in changed)
+    for file in PANELS:
+        if changed or removed or not get_path(f"{file}_panel_csv").exists():
+            print(f"Exporting {file} panel for {len(projects)} projects")
+            export_panel(file, projects)
+        else:
+            print(f"Skip exporting {file} panel")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("Stop building panel")
+        exit(1)
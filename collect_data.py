@@ -1,20 +1,38 @@
+import concurrent.futures
+import itertools
+import math
+import time
+
 import github
 import joblib
 import requests
 
 from common import (
+    PROJECTIONS,
+    archive_raw,
     cleanup_files,
     connect_github,
     force_refresh,
     get_logger,
     get_path,
     initialize,
+    instrument,
+    load_tokens,
+    measure_commit_store,
+    open_archive,
     open_checkpoint,
+    open_commit_store,
     open_commits,
     open_metadata,
     open_patches_raw,
     open_pulls_raw,
+    open_response_cache,
     open_timelines_raw,
+    record_rows,
+    report_schedule,
+    schedule_projects,
+    select_keys,
+    stage,
     tocollect,
     tokens,
 )
@@ -32,18 +50,127 @@ def delete_pull(databases, pull):
             pass
 
 
-def collect_data(project):
+def collect_commits(pull, timeline, commits, commit_store):
+    shas, fetched = [event["sha"] for event in timeline if event.get("event") == "committed"], {}
+    if not shas or any(sha not in commit_store for sha in shas):
+        shas = []
+        for commit in pull.get_commits():
+            shas.append(sha := commit.data["sha"])
+            fetched[sha] = commit.data
+            if sha not in commit_store:
+                commit_store[sha] = select_keys(PROJECTIONS["commit_store"], commit.data)
+    commits[pull.number] = shas
+    return fetched
+
+
+def collect_pull(project, repository, pull, databases, archive=None):
+    pulls, timelines, commits, commit_store, patches = databases
+    pulls[pull.number] = select_keys(PROJECTIONS["pulls_raw"], pull.data)
+    timeline = [event.data for event in repository.get_issue(pull.number).get_timeline()]
+    timelines[pull.number] = select_keys(PROJECTIONS["timelines_raw"], timeline)
+    fetched = collect_commits(pull, timeline, commits, commit_store)
+    patches[pull.number] = requests.get(
+        f"https://patch-diff.githubusercontent.com/raw/{project}/pull/{pull.number}.patch"
+    ).text
+    if archive is not None:
+        archive[pull.number] = {"pull": pull.data, "timeline": timeline, "commits": fetched}
+    record_rows(rows_out=1)
+
+
+def plan_ranges(count, size=50, limit=None):
+    if limit is None:
+        limit = len(tokens)
+    pages = math.ceil(count / 100)
+    ranges = min(limit, math.ceil(pages / size))
+    stops = [math.ceil(pages * (index + 1) / ranges) for index in range(ranges)]
+    return [[start, stop] for start, stop in zip([0, *stops[:-1]], [*stops[:-1], None])]
+
+
+def collect_range(project, checkpoint, databases, first, last, archive=None, attempts=5, metrics=None):
+    logger = get_logger(__file__, modules={"sqlitedict": "WARNING", "urllib3": "ERROR"})
+    if metrics is not None:
+        stage.metrics = metrics
+    token, client = connect_github()
+    failures = 0
+    try:
+        while True:
+            pull_number = None
+            try:
+                logger.info(f"{project}: Collecting pages from {first} to {last or 'the end'} of pull requests")
+                repository = client.get_repo(project)
+                pulls = repository.get_pulls(state="all", direction="asc")
+                for page in itertools.count(checkpoint[f"page{first}"]):
+                    if page == last or not (pull_page := pulls.get_page(page)):
+                        break
+                    for pull in pull_page:
+                        if client.rate_limiting[0] <= tokens[token]:
+                            raise github.RateLimitExceededException(
+                                403, f"Reached custom rate limit for token {token}", headers=None
+                            )
+                        if (pull_number := pull.number) in checkpoint.exclude:
+                            logger.info(f"{project}: Deleting data for pull request {pull_number}")
+                            delete_pull(databases, pull_number)
+                        else:
+                            logger.info(
+                                f"{project}: Collecting data for pull request {pull_number}",
+                                extra={"progress": project},
+                            )
+                            collect_pull(project, repository, pull, databases, archive)
+                        checkpoint["pull"] = pull_number
+                        pull_number = None
+                    checkpoint[f"page{first}"] = page + 1
+                    failures = 0
+            except (github.BadCredentialsException, github.RateLimitExceededException):
+                token, client = connect_github(token)
+            except github.UnknownObjectException:
+                logger.warning(f"{project}: Project does not exist")
+                raise
+            except Exception as exception:
+                if pull_number is not None and (
+                    (isinstance(exception, github.GithubException) and exception.status == 422)
+                    or isinstance(exception, requests.exceptions.RetryError)
+                ):
+                    logger.warning(f"{project}: Skip collecting data for pull request {pull_number} due to {exception}")
+                    checkpoint.exclude_pull(pull_number)
+                else:
+                    logger.error(
+                        f"{project}: Failed collecting pages from {first} to {last or 'the end'} due to {exception}"
+                    )
+                    if (failures := failures + 1) >= attempts:
+                        raise
+                    time.sleep(2**failures)
+            else:
+                break
+    finally:
+        connect_github(token, done=True)
+
+
+def collect_ranges(project, checkpoint, databases, ranges, archive=None):
+    metrics = getattr(stage, "metrics", None)
+    with concurrent.futures.ThreadPoolExecutor(len(ranges)) as executor:
+        for future in [
+            executor.submit(collect_range, project, checkpoint, databases, first, last, archive, metrics=metrics)
+            for first, last in ranges
+        ]:
+            future.result()
+
+
+@instrument
+def collect_data(project, archive=False):
     logger = get_logger(__file__, modules={"sqlitedict": "WARNING", "urllib3": "ERROR"})
     get_path("directory", project).mkdir(parents=True, exist_ok=True)
-    checkpoint = open_checkpoint(project)
-    pulls = open_pulls_raw(project)
-    timelines = open_timelines_raw(project)
-    commits = open_commits(project)
-    patches = open_patches_raw(project)
+    databases = [
+        open_pulls_raw(project, False),
+        open_timelines_raw(project, False),
+        open_commits(project, False),
+        open_commit_store(project, False),
+        open_patches_raw(project, False),
+    ]
+    archive = open_archive(project, False) if archive else None
+    checkpoint = open_checkpoint(project, databases if archive is None else [*databases, archive])
     metadata = open_metadata(project)
     if checkpoint.get("last") is None:
         checkpoint["last"] = 0
-        checkpoint["exclude"] = []
     else:
         logger.info(f"{project}: Last collected data is for pull request {checkpoint.get('pull')}")
     token, client = connect_github()
@@ -51,24 +178,33 @@ def collect_data(project):
         try:
             logger.info(f"{project}: Collecting list of pull requests")
             repository = client.get_repo(project)
-            for pull in repository.get_pulls(state="all", direction="asc")[checkpoint["last"] :]:
-                if client.rate_limiting[0] <= tokens[token]:
-                    raise github.RateLimitExceededException(
-                        403, f"Reached custom rate limit for token {token}", headers=None
-                    )
-                if (pull_number := pull.number) in checkpoint["exclude"]:
-                    logger.info(f"{project}: Deleting data for pull request {pull_number}")
-                    delete_pull([pulls, timelines, commits, patches], pull_number)
-                else:
-                    logger.info(f"{project}: Collecting data for pull request {pull_number}")
-                    pulls[pull_number] = pull.data
-                    timelines[pull_number] = [event.data for event in repository.get_issue(pull_number).get_timeline()]
-                    commits[pull_number] = {commit.data["sha"]: commit.data for commit in pull.get_commits()}
-                    patches[pull_number] = requests.get(
-                        f"https://patch-diff.githubusercontent.com/raw/{project}/pull/{pull_number}.patch"
-                    ).text
-                checkpoint["pull"] = pull_number
-                checkpoint["last"] += 1
+            pulls = repository.get_pulls(state="all", direction="asc")
+            if checkpoint.get("ranges") is None and checkpoint["last"] == 0:
+                checkpoint["ranges"] = plan_ranges(pulls.totalCount)
+                for first, _ in checkpoint["ranges"]:
+                    checkpoint[f"page{first}"] = first
+                checkpoint.flush()
+            if len(checkpoint.get("ranges", [])) > 1:
+                connect_github(token, done=True)
+                collect_ranges(project, checkpoint, databases, checkpoint["ranges"], archive)
+                token, client = connect_github()
+                repository = client.get_repo(project)
+            else:
+                for pull in pulls[checkpoint["last"] :]:
+                    if client.rate_limiting[0] <= tokens[token]:
+                        raise github.RateLimitExceededException(
+                            403, f"Reached custom rate limit for token {token}", headers=None
+                        )
+                    if (pull_number := pull.number) in checkpoint.exclude:
+                        logger.info(f"{project}: Deleting data for pull request {pull_number}")
+                        delete_pull(databases, pull_number)
+                    else:
+                        logger.info(
+                            f"{project}: Collecting data for pull request {pull_number}", extra={"progress": project}
+                        )
+                        collect_pull(project, repository, pull, databases, archive)
+                    checkpoint["pull"] = pull_number
+                    checkpoint["last"] += 1
         except (github.BadCredentialsException, github.RateLimitExceededException):
             token, client = connect_github(token)
         except github.UnknownObjectException:
@@ -79,12 +215,18 @@ def collect_data(project):
                 exception, requests.exceptions.RetryError
             ):
                 logger.warning(f"{project}: Skip collecting data for pull request {pull_number} due to {exception}")
-                checkpoint["exclude"] = [pull_number, *checkpoint["exclude"]]
+                checkpoint.exclude_pull(pull_number)
             else:
                 logger.error(f"{project}: Failed collecting data due to {exception}")
+                checkpoint.flush()
         else:
             metadata.update(repository.data)
             checkpoint.terminate()
+            store = measure_commit_store(project)
+            logger.info(
+                f"{project}: Commit store holds {store['commits']} commits for {store['references']} references "
+                f"(dedup ratio {store['ratio']:.2f}, saved {store['saved'] / 2**20:.1f} MiB)"
+            )
             logger.info(f"{project}: Finished collecting data")
             break
     connect_github(token, done=True)
@@ -95,7 +237,16 @@ def main():
     for project in tocollect():
         if (
             cleanup_files(
-                ["checkpoint", "pulls_raw", "timelines_raw", "commits", "patches_raw", "metadata"],
+                [
+                    "checkpoint",
+                    "pulls_raw",
+                    "timelines_raw",
+                    "commits",
+                    "commit_store",
+                    "patches_raw",
+                    "archive",
+                    "metadata",
+                ],
                 force_refresh(),
                 project,
             )
@@ -104,8 +255,13 @@ def main():
             projects.append(project)
         else:
             print(f"Skip collecting data for project {project}")
-    with joblib.Parallel(n_jobs=len(tokens), prefer="threads", verbose=1) as parallel:
-        parallel(joblib.delayed(collect_data)(project) for project in projects)
+    cache = open_response_cache()
+    projects, predicted = schedule_projects(projects, "collect_data", workers := len(load_tokens()))
+    start = time.perf_counter()
+    with joblib.Parallel(n_jobs=workers, prefer="threads", batch_size=1, verbose=1) as parallel:
+        parallel(joblib.delayed(collect_data)(project, archive_raw()) for project in projects)
+    report_schedule(predicted, start)
+    print(f"Response cache statistics: {cache.statistics()}")
 
 
 if __name__ == "__main__":
@@ -1,29 +1,127 @@
 import argparse
+import atexit
+import collections
+import cProfile
 import csv
 import functools
+import heapq
 import json
 import logging
-import logging.config
+import logging.handlers
+import multiprocessing.connection
 import os
 import pathlib
 import queue
+import resource
+import sqlite3
 import sys
+import threading
+import time
+import zlib
 
+import colorlog
 import github
 import github.GithubObject
+import numpy as np
 import pandas as pd
+import requests
 import sqlitedict
 import urllib3
 import yaml
 
-sys.setrecursionlimit(1_000_000)
 logger = logging.getLogger(__name__)
 DATE = pd.Timestamp(2021, 11, 17)
-with open(pathlib.Path.home() / "tokens.yaml") as file:
-    tokens = yaml.safe_load(file)
+EVENTS = {
+    event: code
+    for code, event in enumerate(
+        [
+            "pulled",
+            "committed",
+            "commented",
+            "reviewed",
+            "line-commented",
+            "commit-commented",
+            "labeled",
+            "unlabeled",
+            "closed",
+            "reopened",
+            "merged",
+            "referenced",
+            "cross-referenced",
+            "mentioned",
+            "subscribed",
+            "unsubscribed",
+            "assigned",
+            "unassigned",
+            "review_requested",
+            "review_request_removed",
+            "review_dismissed",
+            "ready_for_review",
+            "convert_to_draft",
+            "head_ref_deleted",
+            "head_ref_restored",
+            "head_ref_force_pushed",
+            "base_ref_changed",
+            "base_ref_deleted",
+            "base_ref_force_pushed",
+            "automatic_base_change_succeeded",
+            "automatic_base_change_failed",
+            "auto_merge_enabled",
+            "auto_merge_disabled",
+            "auto_squash_enabled",
+            "auto_rebase_enabled",
+            "renamed",
+            "milestoned",
+            "demilestoned",
+            "locked",
+            "unlocked",
+            "pinned",
+            "unpinned",
+            "transferred",
+            "connected",
+            "disconnected",
+            "deployed",
+            "deployment_environment_changed",
+            "marked_as_duplicate",
+            "unmarked_as_duplicate",
+            "added_to_project",
+            "moved_columns_in_project",
+            "removed_from_project",
+            "converted_note_to_issue",
+            "comment_deleted",
+            "user_blocked",
+            "unknown",
+        ]
+    )
+}
+ACTORS = {actor: code for code, actor in enumerate(["ghost", "stale[bot]", "github-actions[bot]"])}
+FIELDS = [
+    "event",
+    "actor.login",
+    "user.login",
+    "author.login",
+    "created_at",
+    "committer.date",
+    "submitted_at",
+    "state",
+    "commit_id",
+    "url",
+    "commit_url",
+    "sha",
+    "label.name",
+    "body",
+]
+PROJECTIONS = {
+    "pulls_raw": ["number", "html_url", "state", "title", "body", "user.login", "created_at"],
+    "timelines_raw": [*FIELDS, *[f"comments.{field}" for field in FIELDS]],
+    "commit_store": ["sha", "author.login"],
+}
+tokens = {}
 tokens_queue = queue.Queue()
-for token in tokens:
-    tokens_queue.put(token)
+stage = threading.local()
+response_cache = None
+log_writer = None
+log_lock = threading.Lock()
 
 
 @property
@@ -34,7 +132,127 @@ def raw_data(self):
 github.GithubObject.GithubObject.data = raw_data
 
 
+class ResponseCache:
+    def __init__(self, file, max_size=2**30, max_age=pd.Timedelta(days=30)):
+        self.connection = sqlite3.connect(file, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        self.max_size = max_size
+        self.max_age = max_age.total_seconds()
+        self.counters = collections.Counter()
+        with self.lock:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(url TEXT PRIMARY KEY, etag TEXT, modified TEXT, headers TEXT, body BLOB, size INTEGER, time REAL)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS responses_time ON responses (time)")
+            self.connection.execute("DELETE FROM responses WHERE time < ?", (time.time() - self.max_age,))
+            self.size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, url):
+        with self.lock:
+            entry = self.connection.execute(
+                "SELECT etag, modified, headers, body, time FROM responses WHERE url = ?", (url,)
+            ).fetchone()
+            if entry is None or entry[4] < time.time() - self.max_age:
+                self.counters["misses"] += 1
+                return None
+        return entry
+
+    def put(self, url, response):
+        etag = response.headers.get("ETag")
+        modified = response.headers.get("Last-Modified")
+        if etag is None and modified is None:
+            return
+        headers = {
+            key: value
+            for key, value in response.headers.items()
+            if key.lower() not in ["content-encoding", "content-length", "transfer-encoding"]
+        }
+        size = len(body := response.content)
+        with self.lock:
+            if previous := self.connection.execute("SELECT size FROM responses WHERE url = ?", (url,)).fetchone():
+                self.size -= previous[0]
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, etag, modified, json.dumps(headers), body, size, time.time()),
+            )
+            self.size += size
+            self.counters["stores"] += 1
+            if self.size > self.max_size:
+                self.evict(self.max_size * 0.9)
+
+    def evict(self, size):
+        for url, length in self.connection.execute("SELECT url, size FROM responses ORDER BY time").fetchall():
+            if self.size <= size:
+                break
+            self.connection.execute("DELETE FROM responses WHERE url = ?", (url,))
+            self.size -= length
+            self.counters["evictions"] += 1
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def restore(self, entry, request, response):
+        self.count("hits")
+        restored = requests.models.Response()
+        restored.status_code = 200
+        restored.reason = "OK"
+        restored.headers = requests.structures.CaseInsensitiveDict({**json.loads(entry[2]), **response.headers})
+        restored._content = entry[3]
+        restored.encoding = requests.utils.get_encoding_from_headers(restored.headers)
+        restored.url = response.url
+        restored.request = request
+        restored.connection = response.connection
+        return restored
+
+    def statistics(self):
+        with self.lock:
+            counters = self.counters.copy()
+            size = self.size
+        lookups = counters["hits"] + counters["revalidations"] + counters["misses"]
+        return {**counters, "size": size, "hit_rate": counters["hits"] / lookups if lookups else 0}
+
+
+def open_response_cache():
+    global response_cache
+    if response_cache is None:
+        response_cache = ResponseCache(get_path("cache"))
+    return response_cache
+
+
+def send_request(send):
+    @functools.wraps(send)
+    def wrapper(adapter, request, *args, **kwargs):
+        if (metrics := getattr(stage, "metrics", None)) is not None:
+            metrics["requests"] += 1
+        if response_cache is None or request.method != "GET":
+            return send(adapter, request, *args, **kwargs)
+        if (entry := response_cache.get(request.url)) is not None:
+            if entry[0] is not None:
+                request.headers["If-None-Match"] = entry[0]
+            if entry[1] is not None:
+                request.headers["If-Modified-Since"] = entry[1]
+        response = send(adapter, request, *args, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            if metrics is not None:
+                metrics["cached"] += 1
+            return response_cache.restore(entry, request, response)
+        if entry is not None:
+            response_cache.count("revalidations")
+        if response.status_code == 200:
+            response_cache.put(request.url, response)
+        return response
+
+    return wrapper
+
+
+requests.adapters.HTTPAdapter.send = send_request(requests.adapters.HTTPAdapter.send)
+
+
 def initialize(directory=None):
+    sys.setrecursionlimit(1_000_000)
+    os.environ.setdefault("RUN_ID", pd.Timestamp.now().strftime("%Y%m%d%H%M%S"))
     if directory is None:
         directory = get_path("data")
     directory = pathlib.Path(__file__).parent / directory
@@ -42,23 +260,67 @@ def initialize(directory=None):
     os.chdir(directory)
 
 
-def get_logger(name, level="INFO", modules=None):
-    name = pathlib.Path(name).stem
-    logging.config.dictConfig(
-        {
-            "version": 1,
-            "formatters": {
-                "file": {
-                    "format": "{asctime}\t{levelname}\t{name}\t{message}",
-                    "datefmt": "%Y-%m-%d %H:%M:%S",
-                    "style": "{",
-                },
-                "stream": {
-                    "()": "colorlog.ColoredFormatter",
-                    "format": "{blue}{asctime}\t{name}\t{message_log_color}{message}",
-                    "datefmt": "%Y-%m-%d %H:%M:%S",
-                    "style": "{",
-                    "secondary_log_colors": {
+class ProgressFilter(logging.Filter):
+    def __init__(self, interval=1):
+        super().__init__()
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.last = {}
+        self.skipped = collections.Counter()
+
+    def filter(self, record):
+        if (progress := getattr(record, "progress", None)) is None:
+            return True
+        key = (record.name, progress)
+        with self.lock:
+            if record.created - self.last.get(key, 0) < self.interval:
+                self.skipped[key] += 1
+                return False
+            self.last[key] = record.created
+            skipped = self.skipped.pop(key, 0)
+        if skipped:
+            record.msg, record.args = f"{record.getMessage()} (skipped {skipped} similar messages)", None
+        return True
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    def emit(self, record):
+        start = time.perf_counter()
+        super().emit(record)
+        if (metrics := getattr(stage, "metrics", None)) is not None:
+            metrics["logs"] += 1
+            metrics["log_time"] += time.perf_counter() - start
+
+
+class ForwardHandler(logging.Handler):
+    def __init__(self, connection):
+        super().__init__()
+        self.connection = connection
+
+    def emit(self, record):
+        try:
+            self.connection.send(record.__dict__)
+        except (OSError, ValueError):
+            self.handleError(record)
+
+
+class LogWriter:
+    def __init__(self, name):
+        self.pid = os.getpid()
+        self.name = name
+        self.file = None
+        self.queue = queue.SimpleQueue()
+        if connection := self.connect():
+            handlers = [ForwardHandler(connection)]
+        else:
+            self.file = self.open_file(name)
+            self.stream = colorlog.StreamHandler()
+            self.stream.setFormatter(
+                colorlog.ColoredFormatter(
+                    "{blue}{asctime}\t{name}\t{message_log_color}{message}",
+                    datefmt="%Y-%m-%d %H:%M:%S",
+                    style="{",
+                    secondary_log_colors={
                         "message": {
                             "DEBUG": "cyan",
                             "INFO": "green",
@@ -67,33 +329,141 @@ def get_logger(name, level="INFO", modules=None):
                             "CRITICAL": "bold_red",
                         }
                     },
-                },
-            },
-            "handlers": {
-                "file": {
-                    "class": "logging.FileHandler",
-                    "formatter": "file",
-                    "filename": f"{name}.log",
-                },
-                "stream": {
-                    "class": "colorlog.StreamHandler",
-                    "formatter": "stream",
-                },
-            },
-            "root": {
-                "level": level,
-                "handlers": ["file", "stream"],
-            },
-            "disable_existing_loggers": False,
-        }
-    )
+                )
+            )
+            handlers = [self.file, self.stream]
+            self.serve()
+        self.listener = logging.handlers.QueueListener(self.queue, *handlers)
+        self.listener.start()
+        atexit.register(self.listener.stop)
+        handler = QueueHandler(self.queue)
+        handler.addFilter(ProgressFilter())
+        root = logging.getLogger()
+        for previous in root.handlers[:]:
+            root.removeHandler(previous)
+        root.addHandler(handler)
+
+    def connect(self):
+        if (address := os.environ.get("LOG_ADDRESS")) is None or os.environ.get("LOG_PID") == str(self.pid):
+            return None
+        try:
+            return multiprocessing.connection.Client(address, authkey=bytes.fromhex(os.environ["LOG_AUTHKEY"]))
+        except OSError:
+            return None
+
+    def serve(self):
+        authkey = os.urandom(16)
+        self.server = multiprocessing.connection.Listener(family="AF_UNIX", authkey=authkey)
+        os.environ.update({"LOG_ADDRESS": self.server.address, "LOG_AUTHKEY": authkey.hex(), "LOG_PID": str(self.pid)})
+        threading.Thread(target=self.accept, daemon=True).start()
+        atexit.register(self.server.close)
+
+    def accept(self):
+        while True:
+            try:
+                connection = self.server.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.receive, args=(connection,), daemon=True).start()
+
+    def receive(self, connection):
+        with connection:
+            while True:
+                try:
+                    self.queue.put(logging.makeLogRecord(connection.recv()))
+                except (EOFError, OSError):
+                    break
+
+    @staticmethod
+    def open_file(name):
+        handler = logging.FileHandler(f"{name}.log")
+        handler.setFormatter(
+            logging.Formatter(
+                "{asctime}\t{levelname}\t{name}\t{process}\t{threadName}\t{message}",
+                datefmt="%Y-%m-%d %H:%M:%S",
+                style="{",
+            )
+        )
+        return handler
+
+    def rename(self, name):
+        self.name = name
+        if self.file is not None:
+            previous, self.file = self.file, self.open_file(name)
+            self.listener.handlers = (self.file, self.stream)
+            previous.close()
+
+
+def get_logger(name, level="INFO", modules=None):
+    global log_writer
+    name = pathlib.Path(name).stem
+    with log_lock:
+        if log_writer is None or log_writer.pid != os.getpid():
+            log_writer = LogWriter(name)
+        elif log_writer.name != name:
+            log_writer.rename(name)
+    logging.getLogger().setLevel(level)
     if modules is not None:
         for module, level in modules.items():
             logging.getLogger(module).setLevel(level)
     return logging.getLogger(name)
 
 
+def record_rows(rows_in=0, rows_out=0):
+    if (metrics := getattr(stage, "metrics", None)) is not None:
+        metrics["rows_in"] += rows_in
+        metrics["rows_out"] += rows_out
+
+
+def instrument(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        projects = args[0] if args else kwargs.get("projects", kwargs.get("project"))
+        projects = projects if isinstance(projects, list) else [projects]
+        previous = getattr(stage, "metrics", None)
+        stage.metrics = metrics = {
+            "run": os.environ["RUN_ID"],
+            "stage": function.__name__,
+            "projects": projects,
+            "rows_in": 0,
+            "rows_out": 0,
+            "requests": 0,
+            "cached": 0,
+            "logs": 0,
+            "log_time": 0.0,
+            "failed": True,
+        }
+        profiler = cProfile.Profile() if (project := os.environ.get("PROFILE_PROJECT")) in projects else None
+        wall_time, cpu_time = time.perf_counter(), time.thread_time()
+        try:
+            result = profiler.runcall(function, *args, **kwargs) if profiler else function(*args, **kwargs)
+            metrics["failed"] = False
+        finally:
+            stage.metrics = previous
+            metrics["wall_time"] = time.perf_counter() - wall_time
+            metrics["cpu_time"] = time.thread_time() - cpu_time
+            metrics["max_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            metrics["pid"] = os.getpid()
+            if profiler:
+                profiler.dump_stats(get_path("directory", project) / f"{function.__name__}.prof")
+            with open(get_path("metrics"), "a") as file:
+                file.write(json.dumps(metrics, default=str) + "\n")
+        return result
+
+    return wrapper
+
+
+def load_tokens():
+    if not tokens:
+        with open(pathlib.Path.home() / "tokens.yaml") as file:
+            tokens.update(yaml.safe_load(file))
+        for token in tokens:
+            tokens_queue.put(token)
+    return tokens
+
+
 def connect_github(token=None, done=False):
+    load_tokens()
     if done:
         tokens_queue.put(token)
     else:
@@ -140,6 +510,18 @@ def lookup_keys(attributes, json):
             return value
 
 
+def select_keys(attributes, json):
+    if isinstance(json, list):
+        return [select_keys(attributes, item) for item in json]
+    if not isinstance(json, dict):
+        return json
+    nested = {}
+    for attribute in attributes:
+        key, _, rest = attribute.partition(".")
+        nested.setdefault(key, []).extend([rest] if rest else [])
+    return {key: select_keys(keys, json[key]) if keys else json[key] for key, keys in nested.items() if key in json}
+
+
 def get_path(file, project=None):
     if project is not None:
         project = project.replace("/", "_").lower()
@@ -147,6 +529,13 @@ def get_path(file, project=None):
     files = {
         # Working directory
         "data": "data/",
+        "benchmark": "benchmark/",
+        # Generated in benchmark_data.py
+        "benchmarks": "benchmarks.csv",
+        # Generated in collect_data.py and fetch_projects.py
+        "cache": "cache.db",
+        # Generated in every instrumented stage
+        "metrics": "metrics.jsonl",
         # Generated in extract_projects.py
         "usage": "usage.csv",
         "projects_extracted": "projects_extracted.csv",
@@ -160,11 +549,17 @@ def get_path(file, project=None):
         "pulls_raw": directory + f"{project}_pulls.db",
         "timelines_raw": directory + f"{project}_timelines.db",
         "commits": directory + f"{project}_commits.db",
+        "commit_store": directory + f"{project}_commit_store.db",
+        "archive": directory + f"{project}_archive.db",
         "patches_raw": directory + f"{project}_patches.db",
         "metadata": directory + f"{project}.db",
+        # Generated in coordinate_data.py
+        "queue": "queue.db",
+        "units": "units/",
         # Generated in preprocess_data.py
         "timelines_fixed": directory + f"{project}_timelines_fixed.db",
         "timelines": directory + f"{project}_timelines.csv",
+        "actors": directory + f"{project}_actors.csv",
         "pulls": directory + f"{project}_pulls.csv",
         "patches": directory + f"{project}_patches.csv",
         # Generated in process_data.py
@@ -174,10 +569,22 @@ def get_path(file, project=None):
         "dataset": directory + f"{project}_dataset.csv",
         # Generated in measure_features.py
         "features": directory + f"{project}_features.csv",
+        "digests": directory + f"{project}_digests.csv",
+        "dirty": directory + f"{project}_dirty.csv",
+        "features_sample": directory + f"{project}_features_sample.csv",
+        "estimates": directory + f"{project}_estimates.csv",
         # Generated in measure_indicators.py
         "features_fixed": directory + f"{project}_features_fixed.csv",
         "activity": directory + f"{project}_activity.csv",
         "indicators": directory + f"{project}_indicators.csv",
+        # Generated in build_panel.py
+        "panel": "panel/",
+        "features_fixed_panel": f"panel/features_fixed/{project}.parquet",
+        "indicators_panel": f"panel/indicators/{project}.parquet",
+        "features_fixed_panel_csv": "panel/features_fixed.csv",
+        "indicators_panel_csv": "panel/indicators.csv",
+        # Generated in query_data.py
+        "spill": "spill/",
     }
     return pathlib.Path(files[file])
 
@@ -186,12 +593,44 @@ def force_refresh():
     parser = argparse.ArgumentParser()
     parser.add_argument("-y", action="store_true", help="force fresh start")
     parser.add_argument("-n", action="store_true", help="do not force fresh start")
-    if (args := parser.parse_args()).y:
+    if (args := parser.parse_known_args()[0]).y:
         return True
     elif args.n:
         return False
 
 
+def update_incrementally():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", action="store_true", help="update existing outputs incrementally")
+    return parser.parse_known_args()[0].i
+
+
+def sample_fraction():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sample", type=float, help="fraction of pull requests to sample from each stratum")
+    return parser.parse_known_args()[0].sample
+
+
+def archive_raw():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--archive", action="store_true", help="archive the full raw payloads compressed")
+    return parser.parse_known_args()[0].archive
+
+
+def keep_fixed():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--keep-fixed", action="store_true", help="keep a debug copy of the fixed timelines")
+    return parser.parse_known_args()[0].keep_fixed
+
+
+def partition_size():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--partition", type=int, help="stream projects from disk in partitions of this many pull requests"
+    )
+    return parser.parse_known_args()[0].partition
+
+
 def cleanup_files(files, fresh=None, project=None):
     if not isinstance(files, list):
         files = [files]
@@ -222,72 +661,415 @@ def check_files(files, project, exclude=None):
     )
 
 
-def open_database(file):
+def open_database(file, autocommit=True, compress=False):
     def encode(data):
-        return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+        data = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+        return sqlite3.Binary(zlib.compress(data.encode())) if compress else data
 
     def decode(data):
-        return json.loads(data)
-
-    return sqlitedict.SqliteDict(file, tablename="data", autocommit=True, encode=encode, decode=decode)
-
-
-def convert_dtypes(function):
-    def wrapper(*args, **kwargs):
-        dataframe = function(*args, **kwargs)
-        for column in dataframe.filter(regex="^time|_at$"):
-            dataframe[column] = pd.to_datetime(dataframe[column]).dt.tz_localize(None)
-        dataframe = dataframe.convert_dtypes()
-        for column in dataframe.select_dtypes("string"):
-            if dataframe[column].nunique() < dataframe[column].count():
-                dataframe[column] = dataframe[column].astype("category")
+        return json.loads(zlib.decompress(data) if compress else data)
+
+    return sqlitedict.SqliteDict(file, tablename="data", autocommit=autocommit, encode=encode, decode=decode)
+
+
+DATETIME = "datetime64[ns]"
+FEATURES = {
+    "pr_description": "Int64",
+    "pr_commits": "Int64",
+    "pr_initial_commits": "Int64",
+    "pr_followup_commits": "Int64",
+    "pr_changed_lines": "Int64",
+    "pr_initial_changed_lines": "Int64",
+    "pr_followup_changed_lines": "Int64",
+    "pr_changed_files": "Int64",
+    "pr_initial_changed_files": "Int64",
+    "pr_followup_changed_files": "Int64",
+    "contributor_pulls": "Int64",
+    "contributor_acceptance_rate": "Float64",
+    "contributor_contribution_period": "Float64",
+    "review_participants": "Int64",
+    "review_comments": "Int64",
+    "review_contributor_comments": "Int64",
+    "review_participant_comments": "Int64",
+    "review_first_latency": "Float64",
+    "review_mean_latency": "Float64",
+    "review_resolution_time": "Float64",
+}
+ACTIVITY = dict.fromkeys(
+    [
+        "opened_pulls",
+        "merged_pulls",
+        "closed_pulls",
+        "active_contributors",
+        "open_pulls",
+        "workload",
+        "events",
+        "staled",
+        "warned",
+        "closed",
+    ],
+    "Int64",
+)
+SCHEMAS = {
+    "usage": {"date": "string", "count": "Int64"},
+    "projects_extracted": {"id": "int64"},
+    "projects_fetched": {
+        "id": "int64",
+        "project": "string",
+        "pulls": "Int64",
+        "stars": "Int64",
+        "archived": "boolean",
+        "fork": "boolean",
+    },
+    "projects": {"project": "string"},
+    "timelines": {
+        "pull_number": "int64",
+        "event_number": "int64",
+        "event": "int32",
+        "actor": "int32",
+        "time": DATETIME,
+        "state": "category",
+        "commit_id": "string",
+        "referenced": "boolean",
+        "sha": "string",
+        "label": "category",
+        "body": "string",
+    },
+    "pulls": {"number": "int64", "html_url": "string", "title": "string", "body": "string"},
+    "patches": {
+        "pull_number": "int64",
+        "sha": "string",
+        "added_lines": "Int64",
+        "deleted_lines": "Int64",
+        "changed_files": "Int64",
+        "files": "string",
+    },
+    "dataframe": {
+        "pull_number": "int64",
+        "event_number": "int64",
+        "event": "int32",
+        "actor": "int32",
+        "time": DATETIME,
+        "sha": "string",
+        "is_open": "boolean",
+        "is_closed": "boolean",
+        "is_merged": "boolean",
+        "opened_at": DATETIME,
+        "closed_at": DATETIME,
+        "merged_at": DATETIME,
+        "closed_by": "Int32",
+        "merged_by": "Int32",
+        "resolved_at": DATETIME,
+        "resolved_by": "Int32",
+        "is_contributor": "boolean",
+        "is_stale_bot": "boolean",
+        "is_stale_action": "boolean",
+        "is_stale": "boolean",
+        "is_staled": "boolean",
+        "first_staled_at": DATETIME,
+        "last_staled_at": DATETIME,
+        "is_stale_closed": "boolean",
+        "first_stale_closed_at": DATETIME,
+        "last_stale_closed_at": DATETIME,
+    },
+    "statistics": {
+        "project": "string",
+        "language": "category",
+        "stars": "Int64",
+        "age": "Float64",
+        **dict.fromkeys(
+            [
+                "contributors",
+                "maintainers",
+                "pulls",
+                "open",
+                "closed",
+                "merged",
+                "staled",
+                "staled+",
+                "stale_closed",
+                "stale_closed+",
+            ],
+            "Int64",
+        ),
+    },
+    "features": {
+        "project": "category",
+        "pull_number": "int64",
+        "contributor": "category",
+        "is_core": "boolean",
+        "is_open": "boolean",
+        "is_closed": "boolean",
+        "is_merged": "boolean",
+        "is_staled": "boolean",
+        "is_stale_closed": "boolean",
+        "opened_at": DATETIME,
+        "closed_at": DATETIME,
+        "merged_at": DATETIME,
+        "resolved_at": DATETIME,
+        "resolved_by": "category",
+        "first_staled_at": DATETIME,
+        "last_staled_at": DATETIME,
+        "first_stale_closed_at": DATETIME,
+        "last_stale_closed_at": DATETIME,
+        **FEATURES,
+    },
+    "digests": {"pull_number": "int64", "digest": "string"},
+    "dirty": {"pull_number": "int64"},
+    "activity": {"project": "category", "month": "int64", **ACTIVITY},
+    "indicators": {
+        "project": "category",
+        "resolved_month": "Int64",
+        "is_merged": "boolean",
+        **dict.fromkeys(FEATURES, "Float64"),
+        **ACTIVITY,
+        "time": "int64",
+        "adoption": "boolean",
+        "time_since_adoption": "Int64",
+        "first_stale_time": DATETIME,
+        "last_stale_time": DATETIME,
+        "stale_activity_period": "Float64",
+        "age_at_adoption": "Float64",
+        "pulls_at_adoption": "Int64",
+        "contributors_at_adoption": "Int64",
+        "maintainers_at_adoption": "Int64",
+    },
+}
+SCHEMAS["dataset"] = {**SCHEMAS["dataframe"], "is_core": "boolean"}
+SCHEMAS["features_fixed"] = {**SCHEMAS["features"], "opened_month": "Int64", "resolved_month": "Int64"}
+
+
+def apply_schema(dataframe, file):
+    schema = SCHEMAS[file]
+    for column in dataframe.columns.intersection(list(schema)):
+        if schema[column] == DATETIME:
+            if pd.api.types.is_datetime64tz_dtype(dataframe[column]):
+                dataframe[column] = dataframe[column].dt.tz_localize(None)
+        elif dataframe[column].dtype != schema[column]:
+            dataframe[column] = dataframe[column].astype(schema[column])
+    return dataframe
+
+
+def read_csv(file, project=None, **kwargs):
+    schema = SCHEMAS[file]
+    dataframe = pd.read_csv(
+        get_path(file, project),
+        dtype={column: dtype for column, dtype in schema.items() if dtype != DATETIME},
+        parse_dates=[column for column, dtype in schema.items() if dtype == DATETIME],
+        low_memory=False,
+        **kwargs,
+    )
+    return apply_schema(dataframe, file)
+
+
+def read_partitions(file, project, size, **kwargs):
+    schema = SCHEMAS[file]
+    buffer = None
+    with pd.read_csv(
+        get_path(file, project),
+        dtype={column: dtype for column, dtype in schema.items() if dtype != DATETIME},
+        parse_dates=[column for column, dtype in schema.items() if dtype == DATETIME],
+        chunksize=2**16,
+        **kwargs,
+    ) as reader:
+        for chunk in reader:
+            buffer = chunk if buffer is None else pd.concat([buffer, chunk])
+            while (pulls := buffer.index.unique("pull_number")).size > size:
+                stop = buffer.index.get_level_values("pull_number").searchsorted(pulls[size])
+                yield apply_schema(buffer.iloc[:stop].copy(), file)
+                buffer = buffer.iloc[stop:]
+    if buffer is not None and not buffer.empty:
+        yield apply_schema(buffer.copy(), file)
+
+
+def serialize_csv(dataframe, **kwargs):
+    return dataframe.to_csv(date_format="%Y-%m-%d %H:%M:%S", **kwargs)
+
+
+class CsvWriter:
+    def __init__(self, file, project=None):
+        self.path = get_path(file, project)
+        self.temporary = self.path.with_name(f"{self.path.name}.part")
+        self.output = None
+
+    def __enter__(self):
+        return self
+
+    def write(self, text):
+        if self.output is None:
+            self.output = open(self.temporary, "w", newline="", encoding="utf-8")
+        else:
+            text = text[text.find("\n") + 1 :]
+        self.output.write(text)
+
+    def __exit__(self, exception_type, exception, traceback):
+        if self.output is not None:
+            self.output.close()
+            if exception_type is None:
+                os.replace(self.temporary, self.path)
+            else:
+                self.temporary.unlink()
+
+
+def write_csv(file, project, dataframe, size=2**16, **kwargs):
+    with CsvWriter(file, project) as writer:
+        for start in range(0, max(len(dataframe), 1), size):
+            writer.write(serialize_csv(dataframe.iloc[start : start + size], **kwargs))
+
+
+def sort_runs(dataframe, keys):
+    if not isinstance(keys, list):
+        keys = [keys]
+    if len(dataframe) < 2 or len(keys) > 2:
+        return dataframe.sort_values(keys)
+    runs = dataframe[keys[0]].to_numpy()
+    boundaries = runs[1:] != runs[:-1]
+    if len(keys) == 2:
+        inner = dataframe[keys[1]].to_numpy()
+        if not (boundaries | (inner[1:] >= inner[:-1])).all():
+            return dataframe.sort_values(keys)
+    starts = np.flatnonzero(np.r_[True, boundaries])
+    if (runs[starts[1:]] > runs[starts[:-1]]).all():
         return dataframe
-
-    return wrapper
+    order = np.argsort(runs[starts], kind="stable")
+    if ((heads := runs[starts][order])[1:] == heads[:-1]).any():
+        return dataframe.sort_values(keys)
+    lengths = np.diff(np.r_[starts, len(runs)])[order]
+    offsets = np.repeat(starts[order] - np.r_[0, np.cumsum(lengths)[:-1]], lengths)
+    return dataframe.take(np.arange(len(runs)) + offsets)
 
 
 def import_events(file):
     return pd.read_json(file, lines=True)
 
 
-@convert_dtypes
+def import_metrics():
+    return pd.read_json(get_path("metrics"), lines=True)
+
+
 def import_usage():
-    return pd.read_csv(get_path("usage"), index_col="date", low_memory=False)
+    return read_csv("usage", index_col="date")
 
 
-@convert_dtypes
 def import_projects_extracted():
-    return pd.read_csv(get_path("projects_extracted"), index_col="id", low_memory=False)
+    return read_csv("projects_extracted", index_col="id")
 
 
-@convert_dtypes
 def import_projects_fetched():
-    return pd.read_csv(get_path("projects_fetched"), index_col="id", low_memory=False)
+    return read_csv("projects_fetched", index_col="id")
 
 
-@convert_dtypes
 def import_projects():
-    return pd.read_csv(get_path("projects"), index_col="project", low_memory=False)
+    return read_csv("projects", index_col="project")
+
+
+def scan_database(file, size=2**10):
+    connection = sqlite3.connect(f"file:{file}?mode=ro", uri=True)
+    cursor = connection.execute('SELECT key, value FROM "data" ORDER BY key')
+    while rows := cursor.fetchmany(size):
+        for key, value in rows:
+            yield key, json.loads(value)
+    connection.close()
+
+
+def measure_commit_store(project):
+    connection = sqlite3.connect(f"file:{get_path('commit_store', project)}?mode=ro", uri=True)
+    connection.execute("ATTACH DATABASE ? AS pulls", (f"file:{get_path('commits', project)}?mode=ro",))
+    commits, stored = connection.execute('SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM "data"').fetchone()
+    references, referenced = connection.execute(
+        'SELECT COUNT(*), COALESCE(SUM(LENGTH(commit_store.value)), 0) FROM pulls."data" AS pull, '
+        'JSON_EACH(pull.value) AS sha JOIN "data" AS commit_store ON commit_store.key = sha.value '
+        "WHERE JSON_TYPE(pull.value) = 'array'"
+    ).fetchone()
+    connection.close()
+    return {
+        "commits": commits,
+        "references": references,
+        "ratio": references / commits if commits else 1,
+        "saved": referenced - stored,
+    }
+
+
+def scan_pulls(project, files=("pulls_raw", "timelines_raw", "commits", "patches_raw")):
+    scans = [scan_database(get_path(file, project)) for file in files[1:]]
+    heads = [next(scan, None) for scan in scans]
+    for key, value in scan_database(get_path(files[0], project)):
+        bundle = [int(key), value]
+        for index, scan in enumerate(scans):
+            while heads[index] is not None and heads[index][0] < key:
+                heads[index] = next(scan, None)
+            bundle.append(heads[index][1] if heads[index] is not None and heads[index][0] == key else None)
+        yield bundle
+
+
+class Checkpoint:
+    def __init__(self, file, databases=(), interval=100):
+        self.database = open_database(file)
+        self.state = dict(self.database)
+        self.exclude = set(self.state.pop("exclude", []))
+        self.databases = databases
+        self.interval = interval
+        self.updates = 0
+        self.lock = threading.RLock()
 
+    def __getitem__(self, key):
+        return self.state[key]
 
-def open_checkpoint(project):
-    return open_database(get_path("checkpoint", project))
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.state[key] = value
+            self.updates += 1
+            if self.updates >= self.interval:
+                self.flush()
 
+    def get(self, key, default=None):
+        return self.state.get(key, default)
 
-def open_pulls_raw(project):
-    return open_database(get_path("pulls_raw", project))
+    def exclude_pull(self, pull_number):
+        with self.lock:
+            self.exclude.add(pull_number)
+            self.flush()
 
+    def flush(self):
+        with self.lock:
+            for database in self.databases:
+                database.commit()
+            self.database.update({**self.state, "exclude": sorted(self.exclude)})
+            self.updates = 0
 
-def open_timelines_raw(project):
-    return open_database(get_path("timelines_raw", project))
+    def terminate(self):
+        with self.lock:
+            for database in self.databases:
+                database.commit()
+            self.database.terminate()
 
 
-def open_commits(project):
-    return open_database(get_path("commits", project))
+def open_checkpoint(project, databases=(), interval=100):
+    return Checkpoint(get_path("checkpoint", project), databases, interval)
 
 
-def open_patches_raw(project):
-    return open_database(get_path("patches_raw", project))
+def open_pulls_raw(project, autocommit=True):
+    return open_database(get_path("pulls_raw", project), autocommit)
+
+
+def open_timelines_raw(project, autocommit=True):
+    return open_database(get_path("timelines_raw", project), autocommit)
+
+
+def open_commits(project, autocommit=True):
+    return open_database(get_path("commits", project), autocommit)
+
+
+def open_commit_store(project, autocommit=True):
+    return open_database(get_path("commit_store", project), autocommit)
+
+
+def open_patches_raw(project, autocommit=True):
+    return open_database(get_path("patches_raw", project), autocommit)
+
+
+def open_archive(project, autocommit=True):
+    return open_database(get_path("archive", project), autocommit, compress=True)
 
 
 def open_metadata(project):
@@ -298,64 +1080,114 @@ def open_timelines_fixed(project):
     return open_database(get_path("timelines_fixed", project))
 
 
-@convert_dtypes
 def import_timelines(project):
-    return pd.read_csv(
-        get_path("timelines", project),
-        index_col=["pull_number", "event_number"],
-        quoting=csv.QUOTE_ALL,
-        escapechar="\\",
-        low_memory=False,
+    return read_csv(
+        "timelines", project, index_col=["pull_number", "event_number"], quoting=csv.QUOTE_ALL, escapechar="\\"
     )
 
 
-@convert_dtypes
+def import_actors(project):
+    return pd.read_csv(get_path("actors", project), index_col="actor_id", keep_default_na=False)["actor"]
+
+
 def import_pulls(project):
-    return pd.read_csv(
-        get_path("pulls", project), index_col="number", quoting=csv.QUOTE_ALL, escapechar="\\", low_memory=False
-    )
+    return read_csv("pulls", project, index_col="number", quoting=csv.QUOTE_ALL, escapechar="\\")
 
 
-@convert_dtypes
 def import_patches(project):
-    return pd.read_csv(
-        get_path("patches", project), index_col=["pull_number", "sha"], quoting=csv.QUOTE_ALL, low_memory=False
-    )
+    return read_csv("patches", project, index_col=["pull_number", "sha"], quoting=csv.QUOTE_ALL)
 
 
-@convert_dtypes
 def import_dataframe(project):
-    return pd.read_csv(get_path("dataframe", project), index_col=["pull_number", "event_number"], low_memory=False)
+    return read_csv("dataframe", project, index_col=["pull_number", "event_number"])
 
 
-@convert_dtypes
 def import_statistics():
-    return pd.read_csv(get_path("statistics"), index_col="project", low_memory=False)
+    return read_csv("statistics", index_col="project")
 
 
-@convert_dtypes
 def import_dataset(project):
-    return pd.read_csv(get_path("dataset", project), index_col=["pull_number", "event_number"], low_memory=False)
+    return read_csv("dataset", project, index_col=["pull_number", "event_number"])
 
 
-@convert_dtypes
 def import_features(project):
-    return pd.read_csv(get_path("features", project), index_col=["pull_number"], low_memory=False)
+    return read_csv("features", project, index_col=["pull_number"])
+
+
+def import_digests(project):
+    return read_csv("digests", project, index_col="pull_number")["digest"]
+
+
+def import_dirty(project):
+    return read_csv("dirty", project)["pull_number"]
 
 
-@convert_dtypes
 def import_features_fixed(project):
-    return pd.read_csv(get_path("features_fixed", project), index_col=["pull_number"], low_memory=False)
+    return read_csv("features_fixed", project, index_col=["pull_number"])
 
 
-@convert_dtypes
 def import_activity(project):
-    return pd.read_csv(get_path("activity", project), index_col="month", low_memory=False)
+    return read_csv("activity", project, index_col="month")
 
 
-@convert_dtypes
 def import_indicators(project):
-    return pd.read_csv(get_path("indicators", project), index_col="time", low_memory=False)
+    return read_csv("indicators", project, index_col="time")
+
+
+def batch_projects(projects, file, size=2**26):
+    batch, total = [], 0
+    for project in projects:
+        if (length := get_path(file, project).stat().st_size) >= size:
+            yield [project]
+        else:
+            batch.append(project)
+            if (total := total + length) >= size:
+                yield batch
+                batch, total = [], 0
+    if batch:
+        yield batch
+
+
+def estimate_costs(projects, file=None):
+    pulls = (
+        import_projects_fetched()
+        .dropna(subset="project")
+        .drop_duplicates("project")
+        .set_index("project")["pulls"]
+        .astype("float64")
+    )
+    costs = pulls.reindex(projects)
+    if file is not None:
+        sizes = pd.Series(
+            {project: path.stat().st_size for project in projects if (path := get_path(file, project)).exists()},
+            dtype="float64",
+        )
+        costs = sizes.reindex(projects).fillna(costs * (sizes / pulls.reindex(sizes.index)).median())
+    return costs.fillna(costs.median()).fillna(1)
+
+
+def schedule_projects(projects, stage, workers, file=None):
+    costs = estimate_costs(list(projects), file).sort_values(ascending=False, kind="stable")
+    finish = [0.0] * workers
+    for cost in costs:
+        heapq.heapreplace(finish, finish[0] + cost)
+    predicted = None
+    if not costs.empty and get_path("metrics").exists():
+        metrics = import_metrics().query("stage == @stage and not failed")
+        metrics = metrics[metrics["projects"].str.len() == 1]
+        if not metrics.empty:
+            wall_times = metrics.groupby(metrics["projects"].str[0])["wall_time"].last()
+            predicted = max(finish) * wall_times.sum() / estimate_costs(list(wall_times.index), file).sum()
+    logger.info(f"Scheduled {len(costs)} projects longest first over {workers} workers")
+    return list(costs.index), predicted
+
+
+def report_schedule(predicted, start):
+    actual = time.perf_counter() - start
+    if predicted is not None and predicted > 0:
+        print(f"Completion time was {actual:.0f}s against {predicted:.0f}s predicted ({actual / predicted - 1:+.0%})")
+    else:
+        print(f"Completion time was {actual:.0f}s without history to predict it")
 
 
 def tofetch():
@@ -385,11 +1217,7 @@ def toanalyze():
 
 
 def preprocessed():
-    return [
-        project
-        for project in toanalyze()
-        if check_files(["timelines", "pulls", "patches"], project, exclude="timelines_fixed")
-    ]
+    return [project for project in toanalyze() if check_files(["timelines", "actors", "pulls", "patches"], project)]
 
 
 def processed():
@@ -0,0 +1,320 @@
+import argparse
+import http.server
+import json
+import math
+import queue
+import socket
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+import joblib
+import requests
+
+from collect_data import collect_range, plan_ranges
+from common import (
+    Checkpoint,
+    collected,
+    connect_github,
+    get_logger,
+    get_path,
+    import_projects_fetched,
+    initialize,
+    load_tokens,
+    open_database,
+)
+
+initialize()
+FILES = ["pulls_raw", "timelines_raw", "commits", "commit_store", "patches_raw", "metadata"]
+POLL = 30
+
+
+class WorkQueue:
+    def __init__(self, file, lease=600, attempts=5):
+        self.connection = sqlite3.connect(file, check_same_thread=False, isolation_level=None)
+        self.lock = threading.RLock()
+        self.lease = lease
+        self.attempts = attempts
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS units (id INTEGER PRIMARY KEY, project TEXT, first INTEGER, last INTEGER, "
+            "status TEXT DEFAULT 'pending', worker TEXT, expires REAL, attempts INTEGER DEFAULT 0, error TEXT)"
+        )
+
+    def add(self, project, ranges):
+        with self.lock:
+            if self.connection.execute("SELECT 1 FROM units WHERE project = ?", (project,)).fetchone() is None:
+                self.connection.executemany(
+                    "INSERT INTO units (project, first, last) VALUES (?, ?, ?)",
+                    [(project, first, last) for first, last in ranges],
+                )
+
+    def lease_unit(self, worker):
+        with self.lock:
+            self.connection.execute(
+                "UPDATE units SET status = 'failed', error = 'Lease expired too often' "
+                "WHERE status = 'leased' AND expires < ? AND attempts >= ?",
+                (time.time(), self.attempts),
+            )
+            unit = self.connection.execute(
+                "SELECT id, project, first, last FROM units "
+                "WHERE status = 'pending' OR (status = 'leased' AND expires < ?) ORDER BY id LIMIT 1",
+                (time.time(),),
+            ).fetchone()
+            if unit is None:
+                return {"unit": None, "finished": self.finished()}
+            self.connection.execute(
+                "UPDATE units SET status = 'leased', worker = ?, expires = ?, attempts = attempts + 1 WHERE id = ?",
+                (worker, time.time() + self.lease, unit[0]),
+            )
+        return {**dict(zip(["unit", "project", "first", "last"], unit)), "lease": self.lease}
+
+    def owns(self, unit, worker):
+        with self.lock:
+            return (
+                self.connection.execute(
+                    "SELECT 1 FROM units WHERE id = ? AND worker = ? AND status = 'leased'", (unit, worker)
+                ).fetchone()
+                is not None
+            )
+
+    def heartbeat(self, unit, worker):
+        with self.lock:
+            leased = self.connection.execute(
+                "UPDATE units SET expires = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+                (time.time() + self.lease, unit, worker),
+            ).rowcount
+        return {"leased": bool(leased)}
+
+    def complete(self, unit, worker):
+        with self.lock:
+            if not self.owns(unit, worker):
+                return {"completed": False, "project": None}
+            self.connection.execute("UPDATE units SET status = 'done', error = NULL WHERE id = ?", (unit,))
+            project = self.connection.execute("SELECT project FROM units WHERE id = ?", (unit,)).fetchone()[0]
+            if self.connection.execute(
+                "SELECT 1 FROM units WHERE project = ? AND status != 'done'", (project,)
+            ).fetchone():
+                project = None
+        return {"completed": True, "project": project}
+
+    def fail(self, unit, worker, error):
+        with self.lock:
+            self.connection.execute(
+                "UPDATE units SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, error = ? "
+                "WHERE id = ? AND worker = ? AND status = 'leased'",
+                (self.attempts, error, unit, worker),
+            )
+        return {"failed": True}
+
+    def units(self, project):
+        with self.lock:
+            return [
+                unit
+                for (unit,) in self.connection.execute(
+                    "SELECT id FROM units WHERE project = ? ORDER BY first", (project,)
+                )
+            ]
+
+    def completed(self):
+        with self.lock:
+            return [
+                project
+                for (project,) in self.connection.execute(
+                    "SELECT project FROM units GROUP BY project HAVING SUM(status != 'done') = 0"
+                )
+            ]
+
+    def finished(self):
+        with self.lock:
+            return (
+                self.connection.execute("SELECT 1 FROM units WHERE status IN ('pending', 'leased')").fetchone() is None
+            )
+
+    def statistics(self):
+        with self.lock:
+            return dict(self.connection.execute("SELECT status, COUNT(*) FROM units GROUP BY status").fetchall())
+
+
+def get_unit_path(unit, file, worker=None):
+    return get_path("units") / (f"{unit}_{file}.db" if worker is None else f"{worker}_{unit}_{file}.db")
+
+
+def merge_units(project, units):
+    logger = get_logger(__file__)
+    logger.info(f"{project}: Merging {len(units)} collected ranges")
+    get_path("directory", project).mkdir(parents=True, exist_ok=True)
+    for file in FILES:
+        connection = sqlite3.connect(get_path(file, project), isolation_level=None)
+        connection.execute('CREATE TABLE IF NOT EXISTS "data" (key TEXT PRIMARY KEY, value BLOB)')
+        for unit in units:
+            if (path := get_unit_path(unit, file)).exists():
+                connection.execute("ATTACH DATABASE ? AS unit", (str(path),))
+                connection.execute('INSERT OR REPLACE INTO "data" SELECT key, value FROM unit."data"')
+                connection.execute("DETACH DATABASE unit")
+        connection.close()
+    for unit in units:
+        for file in FILES:
+            get_unit_path(unit, file).unlink(missing_ok=True)
+    logger.info(f"{project}: Finished merging collected ranges")
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        work_queue = self.server.work_queue
+        path = urllib.parse.urlsplit(self.path)
+        length = int(self.headers.get("Content-Length", 0))
+        if path.path == "/upload":
+            parameters = dict(urllib.parse.parse_qsl(path.query))
+            unit, worker, file = int(parameters["unit"]), parameters["worker"], parameters["file"]
+            if (result := {"uploaded": work_queue.owns(unit, worker) and file in FILES})["uploaded"]:
+                with open(get_unit_path(unit, file), "wb") as output:
+                    while length > 0:
+                        output.write(chunk := self.rfile.read(min(length, 2**20)))
+                        length -= len(chunk)
+        else:
+            body = json.loads(self.rfile.read(length) or "{}")
+            if path.path == "/lease":
+                result = work_queue.lease_unit(**body)
+            elif path.path == "/heartbeat":
+                result = work_queue.heartbeat(**body)
+            elif path.path == "/complete":
+                if (result := work_queue.complete(**body))["project"] is not None:
+                    self.server.merges.put(result["project"])
+            elif path.path == "/fail":
+                result = work_queue.fail(**body)
+            else:
+                self.send_error(404)
+                return
+        response = json.dumps(result).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def merge_projects(work_queue, merges):
+    logger = get_logger(__file__)
+    while True:
+        project = merges.get()
+        try:
+            merge_units(project, work_queue.units(project))
+        except Exception:
+            logger.exception(f"{project}: Failed merging collected ranges")
+        finally:
+            merges.task_done()
+
+
+def serve(host, port):
+    logger = get_logger(__file__)
+    get_path("units").mkdir(parents=True, exist_ok=True)
+    work_queue = WorkQueue(get_path("queue"))
+    projects = (
+        import_projects_fetched().dropna(subset="project").drop_duplicates("project").set_index("project")["pulls"]
+    )
+    for project in projects.index.difference(collected()):
+        if not get_path("checkpoint", project).exists():
+            work_queue.add(project, plan_ranges(projects[project], limit=math.inf))
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.work_queue = work_queue
+    server.merges = queue.Queue()
+    for project in set(work_queue.completed()).difference(collected()):
+        logger.info(f"{project}: Resuming merge of collected ranges")
+        server.merges.put(project)
+    threading.Thread(target=merge_projects, args=(work_queue, server.merges), daemon=True).start()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Serving work queue on {host}:{port} with {work_queue.statistics()}")
+    while not work_queue.finished():
+        time.sleep(10)
+    server.merges.join()
+    time.sleep(2 * POLL)
+    server.shutdown()
+    logger.info(f"Finished coordinating collection with {work_queue.statistics()}")
+
+
+def request(url, path, **kwargs):
+    return requests.post(f"{url}/{path}", timeout=600, **kwargs).json()
+
+
+def keep_alive(url, name, unit, interval, stop):
+    logger = get_logger(__file__)
+    while not stop.wait(interval):
+        try:
+            if not request(url, "heartbeat", json={"unit": unit, "worker": name})["leased"]:
+                logger.warning(f"Lost lease on unit {unit}")
+        except requests.exceptions.RequestException as exception:
+            logger.warning(f"Failed sending heartbeat for unit {unit} due to {exception}")
+
+
+def work_unit(url, name, unit, project, first, last, lease):
+    logger = get_logger(__file__, modules={"sqlitedict": "WARNING", "urllib3": "ERROR"})
+    logger.info(f"{project}: Leased unit {unit} with pages from {first} to {last or 'the end'}")
+    databases = [open_database(get_unit_path(unit, file, name), False) for file in FILES[:-1]]
+    checkpoint = Checkpoint(get_unit_path(unit, "checkpoint", name), databases)
+    if checkpoint.get(f"page{first}") is None:
+        checkpoint[f"page{first}"] = first
+    stop = threading.Event()
+    threading.Thread(target=keep_alive, args=(url, name, unit, lease / 3, stop), daemon=True).start()
+    try:
+        collect_range(project, checkpoint, databases, first, last)
+        if first == 0:
+            token, client = connect_github()
+            open_database(get_unit_path(unit, "metadata", name)).update(client.get_repo(project).data)
+            connect_github(token, done=True)
+        checkpoint.flush()
+        for database in databases:
+            database.close()
+        for file in FILES:
+            if (path := get_unit_path(unit, file, name)).exists():
+                with open(path, "rb") as data:
+                    request(url, "upload", params={"unit": unit, "worker": name, "file": file}, data=data)
+        if not request(url, "complete", json={"unit": unit, "worker": name})["completed"]:
+            logger.warning(f"{project}: Discarding unit {unit} because its lease was lost")
+    except Exception as exception:
+        logger.error(f"{project}: Failed collecting unit {unit} due to {exception}")
+        request(url, "fail", json={"unit": unit, "worker": name, "error": str(exception)})
+    else:
+        checkpoint.terminate()
+        for file in FILES:
+            get_unit_path(unit, file, name).unlink(missing_ok=True)
+    finally:
+        stop.set()
+
+
+def work(url, name):
+    while True:
+        if (unit := request(url, "lease", json={"worker": name}))["unit"] is not None:
+            work_unit(url, name, **unit)
+        elif unit["finished"]:
+            break
+        else:
+            time.sleep(POLL)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", choices=["serve", "work"], help="run the work queue or a collection node")
+    parser.add_argument("--host", default="localhost", help="address to serve the work queue on")
+    parser.add_argument("--port", type=int, default=8642, help="port to serve the work queue on")
+    parser.add_argument("--url", default="http://localhost:8642", help="address of the work queue")
+    parser.add_argument("--name", default=socket.gethostname(), help="name of this collection node")
+    args = parser.parse_known_args()[0]
+    if args.mode == "serve":
+        serve(args.host, args.port)
+    else:
+        get_path("units").mkdir(parents=True, exist_ok=True)
+        workers = len(load_tokens())
+        with joblib.Parallel(n_jobs=workers, prefer="threads", verbose=1) as parallel:
+            parallel(joblib.delayed(work)(args.url, f"{args.name}-{index}") for index in range(workers))
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("Stop coordinating collection")
+        exit(1)
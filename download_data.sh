@@ -1,7 +1,5 @@
 #!/bin/bash
 
 cd "$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)" &&
-    python3 extract_projects.py -n &&
-    python3 fetch_projects.py -n &&
-    python3 collect_data.py -n &&
+    python3 pipeline.py download -n &&
     echo "Finished downloading data"
@@ -1,12 +1,44 @@
+import base64
+
 import github
 import joblib
 import pandas as pd
+import requests
 
-from common import cleanup_files, connect_github, force_refresh, get_logger, get_path, initialize, tofetch, tokens
+from common import (
+    cleanup_files,
+    connect_github,
+    force_refresh,
+    get_logger,
+    get_path,
+    initialize,
+    instrument,
+    load_tokens,
+    open_response_cache,
+    record_rows,
+    tofetch,
+)
 
 initialize()
+QUERY = """
+query ($ids: [ID!]!) {
+  nodes(ids: $ids) {
+    ... on Repository {
+      databaseId
+      nameWithOwner
+      stargazerCount
+      isArchived
+      isFork
+      pullRequests {
+        totalCount
+      }
+    }
+  }
+}
+"""
 
 
+@instrument
 def fetch_metadata(project):
     logger = get_logger(__file__, modules={"urllib3": "ERROR"})
     metadata = {"id": project, "project": None, "pulls": None, "stars": None, "archived": None, "fork": None}
@@ -37,6 +69,60 @@ def fetch_metadata(project):
         else:
             break
     connect_github(token, done=True)
+    record_rows(rows_out=1)
+    return metadata
+
+
+def encode_id(project):
+    return base64.b64encode(f"010:Repository{project}".encode()).decode()
+
+
+@instrument
+def fetch_batch(projects):
+    logger = get_logger(__file__, modules={"urllib3": "ERROR"})
+    token, client = connect_github()
+    while True:
+        try:
+            logger.info(f"{projects[0]}-{projects[-1]}: Fetching metadata for {len(projects)} projects")
+            response = requests.post(
+                "https://api.github.com/graphql",
+                json={"query": QUERY, "variables": {"ids": [encode_id(project) for project in projects]}},
+                headers={"Authorization": f"bearer {token}"},
+                timeout=60,
+            )
+            if response.status_code == 401:
+                raise github.BadCredentialsException(401, f"Token {token} is not valid", headers=None)
+            if response.status_code == 403 or response.headers.get("X-RateLimit-Remaining") == "0":
+                raise github.RateLimitExceededException(403, f"Reached rate limit for token {token}", headers=None)
+            response.raise_for_status()
+            if (nodes := response.json().get("data")) is None:
+                raise ValueError(response.json().get("errors"))
+            nodes = nodes["nodes"]
+        except (github.BadCredentialsException, github.RateLimitExceededException):
+            token, client = connect_github(token)
+        except Exception as exception:
+            logger.error(f"{projects[0]}-{projects[-1]}: Failed fetching metadata in batch due to {exception}")
+            nodes = [None] * len(projects)
+            break
+        else:
+            break
+    connect_github(token, done=True)
+    metadata = []
+    for project, node in zip(projects, nodes):
+        if node is None:
+            metadata.append(fetch_metadata(project))
+        else:
+            metadata.append(
+                {
+                    "id": project,
+                    "project": node["nameWithOwner"].lower(),
+                    "pulls": node["pullRequests"]["totalCount"],
+                    "stars": node["stargazerCount"],
+                    "archived": node["isArchived"],
+                    "fork": node["isFork"],
+                }
+            )
+            record_rows(rows_out=1)
     return metadata
 
 
@@ -48,8 +134,14 @@ def export_projects(metadata):
 
 def main():
     if cleanup_files("projects_fetched", force_refresh()):
-        with joblib.Parallel(n_jobs=len(tokens), prefer="threads", verbose=1) as parallel:
-            export_projects(parallel(joblib.delayed(fetch_metadata)(project) for project in tofetch()))
+        cache = open_response_cache()
+        with joblib.Parallel(n_jobs=len(load_tokens()), prefer="threads", verbose=1) as parallel:
+            projects = list(tofetch())
+            batches = parallel(
+                joblib.delayed(fetch_batch)(projects[index : index + 100]) for index in range(0, len(projects), 100)
+            )
+            export_projects([metadata for batch in batches for metadata in batch])
+        print(f"Response cache statistics: {cache.statistics()}")
     else:
         print("Skip fetching projects")
 
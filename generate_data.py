@@ -0,0 +1,254 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from common import (
+    PROJECTIONS,
+    cleanup_files,
+    get_path,
+    initialize,
+    open_commit_store,
+    open_commits,
+    open_metadata,
+    open_patches_raw,
+    open_pulls_raw,
+    open_timelines_raw,
+    select_keys,
+)
+
+initialize(get_path("benchmark"))
+
+
+def format_time(time):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def generate_actor(rng, login, ghosts):
+    return None if rng.random() < ghosts else {"login": login}
+
+
+def generate_commits(rng, project, pull_number, author, opened_at, commits, files, lines):
+    timeline = {}
+    patch = []
+    for commit_number in range(rng.geometric(1 / commits)):
+        sha = f"{pull_number:020x}{commit_number:020x}"
+        time = format_time(opened_at + pd.Timedelta(hours=rng.integers(-48, 24 * 14)))
+        changed = sorted({f"src/file{rng.integers(files * 20)}.py" for _ in range(rng.geometric(1 / files))})
+        added, deleted = rng.geometric(1 / lines), rng.geometric(1 / max(lines / 2, 1)) - 1
+        timeline[sha] = {
+            "event": "committed",
+            "sha": sha,
+            "url": f"https://api.github.com/repos/{project}/git/commits/{sha}",
+            "author": {"name": author, "email": f"{author}@example.com", "date": time},
+            "committer": {"name": author, "email": f"{author}@example.com", "date": time},
+            "message": f"Change {commit_number} of pull request {pull_number}",
+        }
+        patch.append(
+            f"From {sha} Mon Sep 17 00:00:00 2001\n"
+            f"From: {author} <{author}@example.com>\n"
+            f"Subject: [PATCH] Change {commit_number} of pull request {pull_number}\n\n---\n"
+            f" {len(changed)} file{'s' if len(changed) > 1 else ''} changed, "
+            f"{added} insertion{'s' if added > 1 else ''}(+), {deleted} deletion{'s' if deleted > 1 else ''}(-)\n\n"
+            + "".join(
+                f"diff --git a/{file} b/{file}\n--- a/{file}\n+++ b/{file}\n@@ -1 +1 @@\n-old\n+new\n"
+                for file in changed
+            )
+        )
+    commits = {sha: {"sha": sha, "author": {"login": author}, "commit": {"message": ""}} for sha in timeline}
+    return list(timeline.values()), commits, "".join(patch) + "--\n2.30.0\n"
+
+
+def generate_updates(rng, users, maintainers, author, opened_at, events, ghosts):
+    timeline = []
+    time = opened_at
+    count = rng.geometric(1 / events) * (50 if rng.random() < 0.01 else 1)
+    for _ in range(count):
+        time += pd.Timedelta(minutes=rng.integers(1, 60 * 24 * 7))
+        actor = author if rng.random() < 0.3 else rng.choice(maintainers if rng.random() < 0.7 else users)
+        event = rng.choice(
+            ["commented", "reviewed", "line-commented", "labeled", "mentioned", "subscribed", "head_ref_force_pushed"],
+            p=[0.35, 0.15, 0.15, 0.1, 0.1, 0.1, 0.05],
+        )
+        if event == "reviewed":
+            timeline.append(
+                {
+                    "event": event,
+                    "user": generate_actor(rng, actor, ghosts),
+                    "submitted_at": format_time(time),
+                    "state": rng.choice(["commented", "approved", "changes_requested"]),
+                    "body": "Looks good to me",
+                }
+            )
+        elif event == "line-commented":
+            timeline.append(
+                {
+                    "event": event,
+                    "comments": [
+                        {
+                            "user": generate_actor(rng, actor, ghosts),
+                            "created_at": format_time(time + pd.Timedelta(seconds=second)),
+                            "body": "Please rename this variable",
+                        }
+                        for second in range(rng.geometric(0.5))
+                    ],
+                }
+            )
+        elif event == "labeled":
+            timeline.append(
+                {
+                    "event": event,
+                    "actor": generate_actor(rng, actor, ghosts),
+                    "created_at": format_time(time),
+                    "label": {"name": rng.choice(["bug", "enhancement", "documentation"])},
+                }
+            )
+        else:
+            timeline.append(
+                {
+                    "event": event,
+                    "actor": generate_actor(rng, actor, ghosts),
+                    "created_at": format_time(time),
+                    "body": "Thanks for the contribution",
+                }
+            )
+    return timeline, time
+
+
+def generate_stale(rng, time, closed):
+    bot = rng.choice(["stale[bot]", "github-actions[bot]"])
+    time += pd.Timedelta(days=int(rng.integers(30, 180)))
+    timeline = [
+        {"event": "labeled", "actor": {"login": bot}, "created_at": format_time(time), "label": {"name": "stale"}},
+        {
+            "event": "commented",
+            "actor": {"login": bot},
+            "created_at": format_time(time),
+            "body": "This pull request has been automatically marked as stale because it has not had recent activity.",
+        },
+    ]
+    if closed:
+        time += pd.Timedelta(days=7)
+        timeline.append(
+            {"event": "closed", "actor": {"login": bot}, "created_at": format_time(time), "commit_id": None}
+        )
+    return timeline, time
+
+
+def generate_resolution(rng, project, maintainers, time, state):
+    actor = {"login": rng.choice(maintainers)}
+    time = format_time(time + pd.Timedelta(hours=rng.integers(1, 72)))
+    if state == "merged":
+        return [
+            {"event": "merged", "actor": actor, "created_at": time, "commit_id": "0" * 40},
+            {"event": "closed", "actor": actor, "created_at": time, "commit_id": "0" * 40},
+        ]
+    if state == "referenced":
+        return [
+            {
+                "event": "referenced",
+                "actor": actor,
+                "created_at": time,
+                "commit_id": "0" * 40,
+                "url": f"https://api.github.com/repos/{project}/issues/events/1",
+                "commit_url": f"https://api.github.com/repos/{project}/commits/{'0' * 40}",
+            },
+            {"event": "closed", "actor": actor, "created_at": time, "commit_id": None},
+        ]
+    return [{"event": "closed", "actor": actor, "created_at": time, "commit_id": None}]
+
+
+def generate_data(
+    project,
+    pulls=1000,
+    events=10,
+    commits=3,
+    files=3,
+    lines=40,
+    bots=0.2,
+    contributors=None,
+    ghosts=0.01,
+    seed=0,
+):
+    rng = np.random.default_rng(seed)
+    cleanup_files(["pulls_raw", "timelines_raw", "commits", "commit_store", "patches_raw", "metadata"], True, project)
+    get_path("directory", project).mkdir(parents=True, exist_ok=True)
+    users = [f"user{index}" for index in range(contributors or max(pulls // 5, 1))]
+    maintainers = [f"maintainer{index}" for index in range(max(len(users) // 50, 2))]
+    created_at = pd.Timestamp("2015-01-01")
+    adoption = pulls * 3 // 5
+    pulls_raw = open_pulls_raw(project, False)
+    timelines_raw = open_timelines_raw(project, False)
+    commits_raw = open_commits(project, False)
+    commit_store = open_commit_store(project, False)
+    patches_raw = open_patches_raw(project, False)
+    databases = [pulls_raw, timelines_raw, commits_raw, commit_store, patches_raw]
+    for pull_number in range(1, pulls + 1):
+        opened_at = created_at + pd.Timedelta(days=30) + pd.Timedelta(hours=pull_number * 12 + rng.integers(12))
+        author = rng.choice(users)
+        state = rng.choice(["merged", "referenced", "closed", "open"], p=[0.55, 0.05, 0.25, 0.15])
+        timeline, pull_commits, patch = generate_commits(
+            rng, project, pull_number, author, opened_at, commits, files, lines
+        )
+        updates, time = generate_updates(rng, users, maintainers, author, opened_at, events, ghosts)
+        timeline += updates
+        if pull_number > adoption and state != "merged" and rng.random() < bots * 2:
+            stales, time = generate_stale(rng, time, state == "closed" and rng.random() < 0.5)
+            timeline += stales
+            if len(stales) > 2:
+                state = "stale"
+        if state in ["merged", "referenced", "closed"]:
+            timeline += generate_resolution(rng, project, maintainers, time, state)
+        pulls_raw[pull_number] = {
+            "number": pull_number,
+            "html_url": f"https://github.com/{project}/pull/{pull_number}",
+            "state": "open" if state == "open" else "closed",
+            "title": f"Improve module {rng.integers(files * 20)}",
+            "body": None if rng.random() < 0.1 else "This pull request improves the module. " * rng.geometric(0.3),
+            "user": {"login": author},
+            "created_at": format_time(opened_at),
+        }
+        timelines_raw[pull_number] = select_keys(PROJECTIONS["timelines_raw"], timeline)
+        commits_raw[pull_number] = list(pull_commits)
+        commit_store.update(
+            {sha: select_keys(PROJECTIONS["commit_store"], commit) for sha, commit in pull_commits.items()}
+        )
+        patches_raw[pull_number] = patch
+        if pull_number % 1000 == 0:
+            for database in databases:
+                database.commit()
+    for database in databases:
+        database.commit()
+        database.close()
+    open_metadata(project).update(
+        {"full_name": project, "language": "Python", "watchers": pulls, "created_at": format_time(created_at)}
+    )
+
+
+def parse_arguments(parser=None):
+    if parser is None:
+        parser = argparse.ArgumentParser()
+    parser.add_argument("--project", default="synthetic/project", help="synthetic project name")
+    parser.add_argument("--pulls", type=int, default=1000, help="number of pull requests")
+    parser.add_argument("--events", type=float, default=10, help="mean updates per pull request")
+    parser.add_argument("--commits", type=float, default=3, help="mean commits per pull request")
+    parser.add_argument("--files", type=float, default=3, help="mean changed files per commit")
+    parser.add_argument("--lines", type=float, default=40, help="mean added lines per commit")
+    parser.add_argument("--bots", type=float, default=0.2, help="fraction of pull requests touched by stale bots")
+    parser.add_argument("--contributors", type=int, help="number of contributors")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    return parser.parse_known_args()[0]
+
+
+def main():
+    args = vars(parse_arguments())
+    print(f"Generating data for project {args['project']}")
+    generate_data(**args)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("Stop generating data")
+        exit(1)
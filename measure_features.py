@@ -1,26 +1,48 @@
+import hashlib
+import math
+import zlib
+
 import joblib
 import numpy as np
 import pandas as pd
 
 from common import (
     DATE,
+    EVENTS,
+    FEATURES,
+    SCHEMAS,
+    CsvWriter,
+    batch_projects,
+    check_files,
     cleanup_files,
     force_refresh,
     get_logger,
     get_path,
+    import_actors,
     import_dataset,
+    import_digests,
+    import_features,
     import_patches,
     import_pulls,
     initialize,
+    instrument,
+    partition_size,
     postprocessed,
+    read_partitions,
+    record_rows,
+    sample_fraction,
+    serialize_csv,
+    sort_runs,
+    update_incrementally,
+    write_csv,
 )
 
 initialize()
 
 
-def measure_pull(project, dataset, pulls, patches, pull_number):
+def measure_pull(project, dataset, actors, pulls, patches, pull_number):
     timeline = dataset.query("pull_number == @pull_number")
-    pulled = timeline.query("event == 'pulled'")
+    pulled = timeline.query("event == @EVENTS['pulled']")
     contributor = pulled["actor"].iat[0]
     is_core = pulled["is_core"].iat[0]
     is_open = pulled["is_open"].iat[0]
@@ -42,7 +64,7 @@ def measure_pull(project, dataset, pulls, patches, pull_number):
     title = pulls.loc[pull_number, "title"]
     body = pulls.loc[pull_number, "body"]
     pr_description = (len(title.split()) if pd.notna(title) else 0) + (len(body.split()) if pd.notna(body) else 0)
-    commits = timeline.query("event == 'committed'")
+    commits = timeline.query("event == @EVENTS['committed']")
     initial_commits = commits.query("time <= @opened_at")
     followup_commits = commits.query("time > @opened_at")
     pr_commits = len(commits)
@@ -68,7 +90,9 @@ def measure_pull(project, dataset, pulls, patches, pull_number):
                 changed_files.update(files)
     pr_changed_lines = pr_initial_changed_lines + pr_followup_changed_lines
     pr_changed_files = pr_initial_changed_files + pr_followup_changed_files
-    contributor_pulled = dataset.query("pull_number < @pull_number and event == 'pulled' and actor == @contributor")
+    contributor_pulled = dataset.query(
+        "pull_number < @pull_number and event == @EVENTS['pulled'] and actor == @contributor"
+    )
     contributor_pulls = len(contributor_pulled)
     contributor_acceptance_rate = (
         len(contributor_pulled.query("merged_at < @opened_at")) / contributor_pulls if contributor_pulls else 0
@@ -78,8 +102,12 @@ def measure_pull(project, dataset, pulls, patches, pull_number):
         if not contributor_pulled.empty
         else 0
     )
-    updates = timeline.query("time > opened_at and event not in ['mentioned', 'subscribed'] and not is_stale")
-    comments = updates.query("event in ['commented', 'reviewed', 'line-commented', 'commit-commented']")
+    updates = timeline.query(
+        "time > opened_at and event not in [@EVENTS['mentioned'], @EVENTS['subscribed']] and not is_stale"
+    )
+    comments = updates.query(
+        "event in [@EVENTS['commented'], @EVENTS['reviewed'], @EVENTS['line-commented'], @EVENTS['commit-commented']]"
+    )
     review_participants = updates.query("not is_contributor")["actor"].nunique()
     review_comments = len(comments)
     review_contributor_comments = len(comments.query("is_contributor"))
@@ -102,7 +130,7 @@ def measure_pull(project, dataset, pulls, patches, pull_number):
         # Identifiers
         "project": project,
         "pull_number": pull_number,
-        "contributor": contributor,
+        "contributor": actors[contributor],
         "is_core": is_core,
         "is_open": is_open,
         "is_closed": is_closed,
@@ -113,7 +141,7 @@ def measure_pull(project, dataset, pulls, patches, pull_number):
         "closed_at": closed_at,
         "merged_at": merged_at,
         "resolved_at": resolved_at,
-        "resolved_by": resolved_by,
+        "resolved_by": actors[resolved_by] if pd.notna(resolved_by) else resolved_by,
         "first_staled_at": first_staled_at,
         "last_staled_at": last_staled_at,
         "first_stale_closed_at": first_stale_closed_at,
@@ -144,35 +172,206 @@ def measure_pull(project, dataset, pulls, patches, pull_number):
     }
 
 
+def digest_pulls(dataset, actors, pulls, patches):
+    dataset = dataset.reset_index()
+    for column in ["actor", "closed_by", "merged_by", "resolved_by"]:
+        dataset[column] = dataset[column].map(actors)
+    hashes = pd.concat(
+        [
+            pd.util.hash_pandas_object(dataset, index=False).set_axis(dataset["pull_number"]),
+            pd.util.hash_pandas_object(pulls.reset_index(), index=False).set_axis(pulls.index),
+            pd.util.hash_pandas_object(patches.reset_index(), index=False).set_axis(
+                patches.index.get_level_values("pull_number")
+            ),
+        ]
+    )
+    return (
+        hashes.groupby(level=0)
+        .agg(lambda group: hashlib.blake2b(group.to_numpy().tobytes(), digest_size=8).hexdigest())
+        .rename_axis("pull_number")
+        .rename("digest")
+    )
+
+
+def find_dirty(project, dataset, actors, digests):
+    previous = import_digests(project).astype("object")
+    features = import_features(project)
+    changed = digests.index[digests.ne(previous.reindex(digests.index))].union(previous.index.difference(digests.index))
+    contributors = dataset.query("event == @EVENTS['pulled']").reset_index("event_number")["actor"].map(actors)
+    changed_contributors = (
+        pd.concat(
+            [contributors.reindex(changed).dropna(), features["contributor"].reindex(changed).dropna().astype("object")]
+        )
+        .rename_axis("pull_number")
+        .rename("contributor")
+    )
+    first_changed = changed_contributors.reset_index().groupby("contributor")["pull_number"].min()
+    later = contributors[contributors.index > contributors.map(first_changed).fillna(np.inf)].index
+    return changed.union(later).intersection(digests.index)
+
+
+def merge_features(project, features, digests):
+    previous = pd.read_csv(get_path("features", project), float_precision="round_trip")
+    previous = previous[
+        previous["pull_number"].isin(digests.index) & ~previous["pull_number"].isin(features["pull_number"])
+    ]
+    return pd.concat([previous, features], ignore_index=True)[features.columns]
+
+
+def sample_pulls(project, dataset, fraction):
+    pulled = dataset.query("event == @EVENTS['pulled']").reset_index("event_number")
+    strata = (
+        pd.Series(
+            np.select(
+                [pulled["is_merged"].fillna(False).to_numpy(bool), pulled["is_closed"].fillna(False).to_numpy(bool)],
+                ["merged", "closed"],
+                "open",
+            ),
+            index=pulled.index,
+        )
+        + pulled["is_staled"].map({True: "+staled"}).fillna("")
+        + pulled["is_stale_closed"].map({True: "+stale_closed"}).fillna("")
+    ).rename("stratum")
+    rng = np.random.default_rng(zlib.crc32(project.encode()))
+    sample = strata.groupby(strata, group_keys=False).apply(
+        lambda stratum: stratum.sample(n=math.ceil(len(stratum) * fraction), random_state=rng)
+    )
+    return sample.to_frame().assign(weight=sample.map(strata.value_counts() / sample.value_counts()))
+
+
+def estimate_features(features):
+    strata = features.groupby("stratum")
+    sampled = strata.size()
+    shares = strata["weight"].first() * sampled
+    shares, fractions = shares / shares.sum(), sampled / shares
+    means = strata[list(FEATURES)].mean()
+    variances = strata[list(FEATURES)].var().fillna(0).mul(shares**2 * (1 - fractions) / sampled, axis="index")
+    estimates = pd.DataFrame({"mean": means.mul(shares, axis="index").sum(), "error": np.sqrt(variances.sum())})
+    estimates["lower"] = estimates["mean"] - 1.96 * estimates["error"]
+    estimates["upper"] = estimates["mean"] + 1.96 * estimates["error"]
+    return estimates.rename_axis("feature").assign(pulls=round(features["weight"].sum()), sampled=len(features))
+
+
 def export_features(project, features):
-    pd.DataFrame(features).sort_values(["pull_number"]).to_csv(get_path("features", project), index=False)
+    write_csv("features", project, sort_runs(features, "pull_number"), index=False)
+
+
+def export_features_sample(project, features):
+    sort_runs(features, "pull_number").to_csv(get_path("features_sample", project), index=False)
+
+
+def export_estimates(project, estimates):
+    estimates.assign(project=project).reset_index().set_index("project").to_csv(get_path("estimates", project))
+
 
+def export_digests(project, digests):
+    write_csv("digests", project, digests)
 
-def measure_features(project):
+
+def export_dirty(project, dirty):
+    write_csv("dirty", project, pd.Series(dirty, name="pull_number"), index=False)
+
+
+@instrument
+def measure_features(projects, parallel, incremental=False, fraction=None):
     logger = get_logger(__file__)
-    logger.info(f"{project}: Measuring features")
-    dataset = import_dataset(project)
-    pulls = import_pulls(project)
-    patches = import_patches(project)
-    with joblib.Parallel(n_jobs=-1, prefer="threads", verbose=1) as parallel:
-        export_features(
-            project,
-            parallel(
-                joblib.delayed(measure_pull)(project, dataset, pulls, patches, pull_number)
-                for pull_number in dataset.index.unique("pull_number")
-            ),
+    inputs, digests, dirty, samples = {}, {}, {}, {}
+    for project in projects:
+        logger.info(f"{project}: Measuring features")
+        inputs[project] = (
+            import_dataset(project),
+            import_actors(project),
+            import_pulls(project),
+            import_patches(project),
         )
+        digests[project] = digest_pulls(*inputs[project])
+        if fraction is not None:
+            samples[project] = sample_pulls(project, inputs[project][0], fraction)
+            dirty[project] = samples[project].index
+            logger.info(f"{project}: Sampling {len(dirty[project])} pull requests from {len(digests[project])}")
+        elif incremental:
+            dirty[project] = find_dirty(project, *inputs[project][:2], digests[project])
+            logger.info(f"{project}: Remeasuring features for {len(dirty[project])} changed pull requests")
+        else:
+            dirty[project] = inputs[project][0].index.unique("pull_number")
+    features = pd.DataFrame(
+        parallel(
+            joblib.delayed(measure_pull)(project, *inputs[project], pull_number)
+            for project in projects
+            for pull_number in dirty[project]
+        ),
+        columns=list(SCHEMAS["features"]),
+    )
+    record_rows(rows_in=sum(len(inputs[project][0]) for project in projects), rows_out=len(features))
+    for project in projects:
+        group = features[features["project"] == project]
+        if fraction is not None:
+            group = group.join(samples[project], on="pull_number")
+            export_features_sample(project, group)
+            export_estimates(project, estimate_features(group))
+            continue
+        if incremental:
+            group = merge_features(project, group, digests[project])
+            export_dirty(project, dirty[project])
+        export_features(project, group)
+        export_digests(project, digests[project])
+
+
+@instrument
+def measure_partitions(project, parallel, size):
+    logger = get_logger(__file__)
+    logger.info(f"{project}: Measuring features in partitions of {size} pull requests")
+    actors, pulls, patches = import_actors(project), import_pulls(project), import_patches(project)
+    history, digests, rows_in, rows_out = [], [], 0, 0
+    with CsvWriter("features", project) as writer:
+        for partition in read_partitions("dataset", project, size, index_col=["pull_number", "event_number"]):
+            pull_numbers = partition.index.unique("pull_number")
+            dataset = pd.concat([*history, partition])
+            features = pd.DataFrame(
+                parallel(
+                    joblib.delayed(measure_pull)(project, dataset, actors, pulls, patches, pull_number)
+                    for pull_number in pull_numbers
+                ),
+                columns=list(SCHEMAS["features"]),
+            )
+            writer.write(serialize_csv(sort_runs(features, "pull_number"), index=False))
+            digests.append(
+                digest_pulls(
+                    partition,
+                    actors,
+                    pulls[pulls.index.isin(pull_numbers)],
+                    patches[patches.index.get_level_values("pull_number").isin(pull_numbers)],
+                )
+            )
+            history.append(partition.query("event == @EVENTS['pulled']"))
+            rows_in, rows_out = rows_in + len(partition), rows_out + len(features)
+    export_digests(project, pd.concat(digests))
+    record_rows(rows_in=rows_in, rows_out=rows_out)
 
 
 def main():
-    projects = []
+    if (fraction := sample_fraction()) is not None:
+        with joblib.Parallel(n_jobs=-1, prefer="threads", verbose=1) as parallel:
+            for batch in batch_projects(postprocessed(), "dataset"):
+                measure_features(batch, parallel, fraction=fraction)
+        return
+    projects, updates = [], []
     for project in postprocessed():
-        if cleanup_files("features", force_refresh(), project):
+        if update_incrementally() and check_files(["features", "digests"], project):
+            updates.append(project)
+        elif cleanup_files(["features", "digests", "dirty"], force_refresh(), project):
             projects.append(project)
         else:
             print(f"Skip measuring features for project {project}")
-    for project in projects:
-        measure_features(project)
+    with joblib.Parallel(n_jobs=-1, prefer="threads", verbose=1) as parallel:
+        if size := partition_size():
+            for project in projects:
+                measure_partitions(project, parallel, size)
+        else:
+            for batch in batch_projects(projects, "dataset"):
+                measure_features(batch, parallel)
+        for batch in batch_projects(updates, "dataset"):
+            measure_features(batch, parallel, True)
 
 
 if __name__ == "__main__":
@@ -3,26 +3,36 @@ import numpy as np
 import pandas as pd
 
 from common import (
+    EVENTS,
+    apply_schema,
+    check_files,
     cleanup_files,
-    convert_dtypes,
     force_refresh,
     get_logger,
-    get_path,
+    import_activity,
     import_dataset,
+    import_dirty,
     import_features,
+    import_features_fixed,
+    import_indicators,
     initialize,
+    instrument,
     measured,
     open_metadata,
+    partition_size,
+    read_partitions,
+    record_rows,
+    update_incrementally,
+    write_csv,
 )
 
 initialize()
 
 
-@convert_dtypes
 def add_stale_warning(stales):
     def find_stale_warning(events):
-        events["is_warning"] = events["event"].isin(["commented", "labeled"]) & ~(
-            events.shift(-1)["event"].eq("closed")
+        events["is_warning"] = events["event"].isin([EVENTS["commented"], EVENTS["labeled"]]) & ~(
+            events.shift(-1)["event"].eq(EVENTS["closed"])
             & (events.shift(-1)["time"] - events["time"]).le(np.timedelta64(1, "m"))
         )
         return events
@@ -30,7 +40,6 @@ def add_stale_warning(stales):
     return stales.groupby("pull_number", group_keys=False).apply(find_stale_warning)
 
 
-@convert_dtypes
 def measure_activity(stales):
     def measure_month(events):
         return pd.Series(
@@ -38,7 +47,7 @@ def measure_activity(stales):
                 "events": len(events),
                 "staled": events.index.get_level_values("pull_number").nunique(),
                 "warned": events.query("is_warning").index.get_level_values("pull_number").nunique(),
-                "closed": events.query("event == 'closed'").index.get_level_values("pull_number").nunique(),
+                "closed": events.query("event == @EVENTS['closed']").index.get_level_values("pull_number").nunique(),
             }
         )
 
@@ -46,25 +55,50 @@ def measure_activity(stales):
     return activity.reindex(range(activity.index.min(), activity.index.max() + 1), fill_value=0)
 
 
+def measure_workload(features, months):
+    monthly = pd.DataFrame()
+    for month in months:
+        opened = features.query("opened_month == @month")
+        resolved = features.query("resolved_month == @month")
+        monthly.loc[month, "opened_pulls"] = len(opened)
+        monthly.loc[month, "merged_pulls"] = len(resolved.query("is_merged"))
+        monthly.loc[month, "closed_pulls"] = len(resolved.query("is_closed"))
+        monthly.loc[month, "active_contributors"] = opened["contributor"].nunique()
+    return monthly
+
+
+def summarize_stales(project, size=None):
+    if size is None:
+        partitions = [import_dataset(project)]
+    else:
+        partitions = read_partitions("dataset", project, size, index_col=["pull_number", "event_number"])
+    stales, cores, rows = [], [], 0
+    for partition in partitions:
+        stales.append(partition.query("is_stale"))
+        cores.append(partition.query("is_core").groupby("actor")["time"].min())
+        rows += len(partition)
+    return apply_schema(pd.concat(stales), "dataset"), pd.concat(cores).groupby(level=0).min(), rows
+
+
 def export_features_fixed(project, features):
-    features.reset_index().set_index("project").to_csv(get_path("features_fixed", project))
+    write_csv("features_fixed", project, features.reset_index().set_index("project"))
 
 
 def export_activity(project, activity):
-    activity.assign(project=project).reset_index().set_index("project").to_csv(get_path("activity", project))
+    write_csv("activity", project, activity.assign(project=project).reset_index().set_index("project"))
 
 
 def export_indicators(project, indicators):
-    indicators.assign(project=project).set_index("project").to_csv(get_path("indicators", project))
+    write_csv("indicators", project, indicators.assign(project=project).set_index("project"))
 
 
-def measure_indicators(project):
+@instrument
+def measure_indicators(project, incremental=False, size=None):
     logger = get_logger(__file__, modules={"sqlitedict": "WARNING"})
     logger.info(f"{project}: Measuring indicators")
-    dataset = import_dataset(project)
+    stales, cores, rows = summarize_stales(project, size)
     features = import_features(project)
     metadata = open_metadata(project)
-    stales = dataset.query("is_stale").copy()
     if project == "automattic/wp-calypso":
         first_stale = pd.Timestamp("2019-04-20 05:46:48")
         stales = stales.query("time >= @first_stale").copy()
@@ -78,22 +112,36 @@ def measure_indicators(project):
     features = features[features[characteristics].ge(0).all(axis="columns")].copy()
     features["opened_month"] = (features["opened_at"] - first_stale) // np.timedelta64(1, "M")
     features["resolved_month"] = (features["resolved_at"] - first_stale) // np.timedelta64(1, "M")
-    monthly = pd.DataFrame()
-    for month in range(
-        features["opened_month"].min(), int(features[["opened_month", "resolved_month"]].max().max() + 1)
-    ):
-        opened = features.query("opened_month == @month")
-        resolved = features.query("resolved_month == @month")
-        monthly.loc[month, "opened_pulls"] = len(opened)
-        monthly.loc[month, "merged_pulls"] = len(resolved.query("is_merged"))
-        monthly.loc[month, "closed_pulls"] = len(resolved.query("is_closed"))
-        monthly.loc[month, "active_contributors"] = opened["contributor"].nunique()
+    months = range(features["opened_month"].min(), int(features[["opened_month", "resolved_month"]].max().max() + 1))
+    if incremental and import_indicators(project)["first_stale_time"].eq(first_stale).any():
+        monthly = import_activity(project)[["opened_pulls", "merged_pulls", "closed_pulls", "active_contributors"]]
+        monthly = monthly.reindex(months).astype("float64")
+        dirty = import_dirty(project)
+        previous = import_features_fixed(project)
+        dirty_months = (
+            pd.concat(
+                [
+                    previous.loc[previous.index.intersection(dirty), ["opened_month", "resolved_month"]],
+                    features.loc[features.index.intersection(dirty), ["opened_month", "resolved_month"]],
+                ]
+            )
+            .stack()
+            .astype("int64")
+            .pipe(set)
+            .union(monthly.index[monthly.isna().any(axis="columns")])
+            .intersection(months)
+        )
+        logger.info(f"{project}: Remeasuring activity for {len(dirty_months)} changed months")
+        if dirty_months:
+            monthly.loc[sorted(dirty_months)] = measure_workload(features, sorted(dirty_months))
+    else:
+        monthly = measure_workload(features, months)
     monthly["open_pulls"] = (
         (monthly["opened_pulls"] - monthly["merged_pulls"] - monthly["closed_pulls"]).cumsum().shift(1, fill_value=0)
     )
     monthly["workload"] = monthly["opened_pulls"] + monthly["open_pulls"]
     monthly.index.name = "month"
-    activity = monthly.join(activity).fillna(0)
+    activity = apply_schema(monthly.join(activity).fillna(0), "activity")
     indicators = (
         features.groupby(["resolved_month", "is_merged"], as_index=False)
         .agg(dict.fromkeys(characteristics, "mean"))
@@ -111,21 +159,28 @@ def measure_indicators(project):
     features_before = features.query("opened_month < 0")
     indicators["pulls_at_adoption"] = len(features_before)
     indicators["contributors_at_adoption"] = features_before["contributor"].nunique()
-    indicators["maintainers_at_adoption"] = dataset.query("time < @first_stale and is_core")["actor"].nunique()
+    indicators["maintainers_at_adoption"] = cores.lt(first_stale).sum()
     export_features_fixed(project, features)
     export_activity(project, activity)
     export_indicators(project, indicators)
+    record_rows(rows_in=rows, rows_out=len(indicators))
 
 
 def main():
-    projects = []
+    get_logger(__file__)
+    projects = {}
     for project in measured():
-        if cleanup_files(["features_fixed", "activity", "indicators"], force_refresh(), project):
-            projects.append(project)
+        if update_incrementally() and check_files(["dirty", "features_fixed", "activity", "indicators"], project):
+            projects[project] = True
+        elif cleanup_files(["features_fixed", "activity", "indicators"], force_refresh(), project):
+            projects[project] = False
         else:
             print(f"Skip measuring indicators for project {project}")
+    size = partition_size()
     with joblib.Parallel(n_jobs=-1, verbose=1) as parallel:
-        parallel(joblib.delayed(measure_indicators)(project) for project in projects)
+        parallel(
+            joblib.delayed(measure_indicators)(project, incremental, size) for project, incremental in projects.items()
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,32 @@
+import argparse
+import importlib
+
+STAGES = {
+    "download": ["extract_projects", "fetch_projects", "collect_data"],
+    "analyze": [
+        "preprocess_data",
+        "process_data",
+        "postprocess_data",
+        "measure_features",
+        "measure_indicators",
+        "build_panel",
+    ],
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "stages", nargs="+", choices=[*STAGES, *[stage for stages in STAGES.values() for stage in stages]]
+    )
+    for stage in parser.parse_known_args()[0].stages:
+        for module in STAGES.get(stage, [stage]):
+            importlib.import_module(module).main()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("Stop running pipeline")
+        exit(1)
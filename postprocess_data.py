@@ -3,60 +3,59 @@ import numpy as np
 import pandas as pd
 
 from common import (
+    ACTORS,
+    EVENTS,
+    CsvWriter,
+    apply_schema,
     cleanup_files,
-    convert_dtypes,
     force_refresh,
     get_logger,
     get_path,
     import_dataframe,
     initialize,
+    instrument,
     open_metadata,
+    partition_size,
     processed,
+    read_partitions,
+    record_rows,
+    serialize_csv,
+    write_csv,
 )
 
 initialize()
 
 
-@convert_dtypes
-def add_core(dataframe):
-    def find_core(events):
-        events = events.assign(is_core=False)
-        if (actor := events["actor"].iat[0]) != "ghost":  # noqa: F841
-            events.loc[
-                events["time"]
-                >= min(
-                    events.query("not is_contributor and closed_by == @actor")["closed_at"].min(),
-                    events.query("merged_by == @actor")["merged_at"].min(),
-                ),
-                "is_core",
-            ] = True
-        return events
+def summarize_core(dataframe):
+    closed = dataframe[dataframe["closed_by"].eq(dataframe["actor"]).fillna(False) & ~dataframe["is_contributor"]]
+    merged = dataframe[dataframe["merged_by"].eq(dataframe["actor"]).fillna(False)]
+    return pd.DataFrame(
+        {
+            "closed_at": closed.groupby("actor")["closed_at"].min(),
+            "merged_at": merged.groupby("actor")["merged_at"].min(),
+        }
+    )
 
-    return dataframe.groupby("actor", group_keys=False).apply(find_core)
 
+def merge_core(summaries):
+    summaries = pd.concat(summaries).groupby(level=0).min()
+    core_times = summaries["closed_at"].mask(summaries["merged_at"] < summaries["closed_at"], summaries["merged_at"])
+    return core_times.drop(ACTORS["ghost"], errors="ignore")
 
-def select_pulls(dataframe, query):
-    return dataframe.query(query).index.unique("pull_number")
 
-
-def export_dataset(project, dataset):
-    dataset.to_csv(get_path("dataset", project))
+def add_core(dataframe, core_times):
+    dataframe["is_core"] = dataframe["time"] >= dataframe["actor"].map(core_times)
+    return dataframe
 
 
-def postprocess_data(project):
-    logger = get_logger(__file__, modules={"sqlitedict": "WARNING"})
-    logger.info(f"{project}: Postprocessing data")
-    dataframe = import_dataframe(project)
-    metadata = open_metadata(project)
-    dataframe = add_core(dataframe)
-    pulled = dataframe.query("event == 'pulled'")
-    statistics = {
+def summarize_dataset(project, metadata, pulled, maintainers):
+    return {
         "project": project,
         "language": metadata["language"],
         "stars": metadata["watchers"],
         "age": (pulled["time"].max() - pd.Timestamp(metadata["created_at"]).tz_localize(None)) / np.timedelta64(1, "M"),
         "contributors": pulled["actor"].nunique(),
-        "maintainers": dataframe.query("is_core")["actor"].nunique(),
+        "maintainers": len(maintainers),
         "pulls": len(pulled),
         "open": len(select_pulls(pulled, "is_open")),
         "closed": len(select_pulls(pulled, "is_closed")),
@@ -66,7 +65,51 @@ def postprocess_data(project):
         "stale_closed": len(select_pulls(pulled, "is_stale_closed")),
         "stale_closed+": len(select_pulls(pulled, "is_stale_closed and is_merged")),
     }
+
+
+def select_pulls(dataframe, query):
+    return dataframe.query(query).index.unique("pull_number")
+
+
+def export_dataset(project, dataset):
+    write_csv("dataset", project, dataset)
+
+
+@instrument
+def postprocess_data(project):
+    logger = get_logger(__file__, modules={"sqlitedict": "WARNING"})
+    logger.info(f"{project}: Postprocessing data")
+    dataframe = import_dataframe(project)
+    metadata = open_metadata(project)
+    dataframe = apply_schema(add_core(dataframe, merge_core([summarize_core(dataframe)])), "dataset")
+    pulled = dataframe.query("event == @EVENTS['pulled']")
+    statistics = summarize_dataset(project, metadata, pulled, dataframe.query("is_core")["actor"].unique())
+    logger.info(f"{project}: Dataset takes {dataframe.memory_usage(deep=True).sum() / 2**20:.1f} MiB in memory")
     export_dataset(project, dataframe)
+    record_rows(rows_in=len(dataframe), rows_out=len(dataframe))
+    return statistics
+
+
+@instrument
+def postprocess_partitions(project, size):
+    logger = get_logger(__file__, modules={"sqlitedict": "WARNING"})
+    logger.info(f"{project}: Postprocessing data in partitions of {size} pull requests")
+    metadata = open_metadata(project)
+    index_col = ["pull_number", "event_number"]
+    core_times = merge_core(
+        summarize_core(dataframe) for dataframe in read_partitions("dataframe", project, size, index_col=index_col)
+    )
+    pulled, maintainers, rows, memory = [], set(), 0, 0
+    with CsvWriter("dataset", project) as writer:
+        for dataframe in read_partitions("dataframe", project, size, index_col=index_col):
+            dataframe = apply_schema(add_core(dataframe, core_times), "dataset")
+            pulled.append(dataframe.query("event == @EVENTS['pulled']"))
+            maintainers.update(dataframe.query("is_core")["actor"].unique())
+            rows, memory = rows + len(dataframe), max(memory, dataframe.memory_usage(deep=True).sum())
+            writer.write(serialize_csv(dataframe))
+    statistics = summarize_dataset(project, metadata, pd.concat(pulled), maintainers)
+    logger.info(f"{project}: Dataset partitions take at most {memory / 2**20:.1f} MiB in memory")
+    record_rows(rows_in=rows, rows_out=rows)
     return statistics
 
 
@@ -76,6 +119,7 @@ def export_statistics(statistics):
 
 
 def main():
+    get_logger(__file__)
     fresh = force_refresh()
     if not cleanup_files("statistics", fresh):
         print("Skip refreshing statistics")
@@ -86,7 +130,10 @@ def main():
         else:
             print(f"Skip postprocessing data for project {project}")
     with joblib.Parallel(n_jobs=-1, verbose=1) as parallel:
-        export_statistics(parallel(joblib.delayed(postprocess_data)(project) for project in projects))
+        if size := partition_size():
+            export_statistics(parallel(joblib.delayed(postprocess_partitions)(project, size) for project in projects))
+        else:
+            export_statistics(parallel(joblib.delayed(postprocess_data)(project) for project in projects))
 
 
 if __name__ == "__main__":
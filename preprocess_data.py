@@ -1,32 +1,54 @@
 import csv
+import functools
 import re
+import time
 
 import joblib
 import pandas as pd
 
 from common import (
+    ACTORS,
+    EVENTS,
     cleanup_files,
     force_refresh,
     get_logger,
     get_path,
     initialize,
+    instrument,
+    keep_fixed,
     lookup_keys,
-    open_commits,
-    open_patches_raw,
-    open_pulls_raw,
+    open_commit_store,
     open_timelines_fixed,
-    open_timelines_raw,
+    record_rows,
+    report_schedule,
+    scan_pulls,
+    schedule_projects,
+    sort_runs,
     toanalyze,
+    write_csv,
 )
 
 initialize()
-
-
-def fix_committed(timeline, commits):
+TIMELINES = [
+    "pull_number",
+    "event_number",
+    "event",
+    "actor",
+    "time",
+    "state",
+    "commit_id",
+    "referenced",
+    "sha",
+    "label",
+    "body",
+]
+
+
+def fix_committed(timeline, authors):
     events = []
     for event in timeline:
         if event["event"] == "committed":
-            event["author"]["login"] = lookup_keys("author.login", commits[event["sha"]])
+            event["author"]["login"] = authors(event["sha"])
         events.append(event)
     return events
 
@@ -91,8 +113,8 @@ def add_pull_and_event_number(timeline):
     return events
 
 
-def fix_timeline(timeline, pull, commits):
-    timeline = fix_committed(timeline, commits)
+def fix_timeline(timeline, pull, authors):
+    timeline = fix_committed(timeline, authors)
     timeline = fix_referenced(timeline)
     timeline = fix_labeled_and_unlabeled(timeline)
     timeline = unpack_line_and_commit_commented(timeline)
@@ -103,113 +125,154 @@ def fix_timeline(timeline, pull, commits):
     return timeline
 
 
-def fix_timelines(project, timelines, pulls, commits):
-    fixed = open_timelines_fixed(project)
-    for pull in pulls:
-        fixed[pull] = fix_timeline(timelines[pull], pulls[pull], commits[pull])
-    return fixed
+def lookup_authors(project, size=2**16):
+    commit_store = open_commit_store(project) if get_path("commit_store", project).exists() else {}
 
+    @functools.lru_cache(maxsize=size)
+    def lookup_author(sha):
+        return lookup_keys("author.login", commit_store[sha])
 
-def filter_timelines(timelines):
-    rows = []
-    for timeline in timelines.values():
-        for event in timeline:
-            row = {}
-            for column in [
-                "pull_number",
-                "event_number",
-                "event",
-                "actor",
-                "time",
-                "state",
-                "commit_id",
-                "referenced",
-                "sha",
-                "label",
-                "body",
-            ]:
-                row[column] = lookup_keys(column, event)
-            rows.append(row)
-    return rows
+    return lookup_author
 
 
-def filter_pulls(pulls):
+def fix_timelines(project, bundles, pulls, patches, authors, fixed=None):
+    logger = get_logger(__file__, modules={"sqlitedict": "WARNING"})
+    for pull_number, pull, timeline, commits, patch in bundles:
+        if timeline is None or commits is None:
+            logger.warning(f"{project}: Skip pull request {pull_number} without collected timeline or commits")
+            continue
+        pulls.append(filter_pull(pull))
+        patches += filter_patch(pull_number, patch if patch is not None else "")
+        if isinstance(commits, dict):
+            timeline = fix_timeline(timeline, pull, lambda sha: lookup_keys("author.login", commits[sha]))
+        else:
+            timeline = fix_timeline(timeline, pull, authors)
+        if fixed is not None:
+            fixed[pull_number] = timeline
+        yield timeline
+
+
+def filter_timeline(timeline):
     rows = []
-    for pull in pulls.values():
+    for event in timeline:
         row = {}
-        for column in ["number", "html_url", "title", "body"]:
-            row[column] = lookup_keys(column, pull)
+        for column in TIMELINES:
+            row[column] = lookup_keys(column, event)
         rows.append(row)
     return rows
 
 
-def filter_patches(patches):
+def filter_timelines(timelines, size=1000):
+    batches, rows = [], []
+    for pulls, timeline in enumerate(timelines, 1):
+        rows += filter_timeline(timeline)
+        if pulls % size == 0 and rows:
+            batches.append(pd.DataFrame(rows, columns=TIMELINES))
+            rows = []
+    if rows or not batches:
+        batches.append(pd.DataFrame(rows, columns=TIMELINES))
+    return pd.concat(batches, ignore_index=True)
+
+
+def encode_timelines(timelines):
+    timelines["event"] = timelines["event"].map(EVENTS).fillna(EVENTS["unknown"]).astype("int32")
+    actors = pd.Index(list(ACTORS)).append(pd.Index(timelines["actor"].unique()).difference(list(ACTORS)))
+    timelines["actor"] = actors.get_indexer(timelines["actor"]).astype("int32")
+    return timelines, pd.Series(actors, name="actor").rename_axis("actor_id")
+
+
+def filter_pull(pull):
+    row = {}
+    for column in ["number", "html_url", "title", "body"]:
+        row[column] = lookup_keys(column, pull)
+    return row
+
+
+def filter_patch(pull_number, patch):
     changes = []
-    for pull_number, patch in patches.items():
-        for diff in re.findall(
-            (
-                r"(?ms)^From \S+ Mon Sep 17 00:00:00 2001$.+?^---$.+?(?=^From \S+ Mon Sep 17 00:00:00 2001$.+?^---$)"
-                r"|^From \S+ Mon Sep 17 00:00:00 2001$.+?^---$.+"
-            ),
-            patch,
-        ):
-            added_lines = re.search(r"(?m)^ .+?(\d+) insertions?\(\+\)", diff)
-            deleted_lines = re.search(r"(?m)^ .+?(\d+) deletions?\(\-\)", diff)
-            changed_files = re.search(r"(?m)^ (\d+) files? changed,", diff)
-            changes.append(
-                {
-                    "pull_number": int(pull_number),
-                    "sha": re.match(r"(?ms)^From (\S+) Mon Sep 17 00:00:00 2001$.+?^---$", diff).group(1),
-                    "added_lines": added_lines.group(1) if added_lines else 0,
-                    "deleted_lines": deleted_lines.group(1) if deleted_lines else 0,
-                    "changed_files": changed_files.group(1) if changed_files else 0,
-                    "files": list(re.findall(r"(?m)^diff --git \"?a/(.+)\"? \"?b/.+\"?$", diff)),
-                }
-            )
-    return changes
+    for diff in re.findall(
+        (
+            r"(?ms)^From \S+ Mon Sep 17 00:00:00 2001$.+?^---$.+?(?=^From \S+ Mon Sep 17 00:00:00 2001$.+?^---$)"
+            r"|^From \S+ Mon Sep 17 00:00:00 2001$.+?^---$.+"
+        ),
+        patch,
+    ):
+        added_lines = re.search(r"(?m)^ .+?(\d+) insertions?\(\+\)", diff)
+        deleted_lines = re.search(r"(?m)^ .+?(\d+) deletions?\(\-\)", diff)
+        changed_files = re.search(r"(?m)^ (\d+) files? changed,", diff)
+        changes.append(
+            {
+                "pull_number": pull_number,
+                "sha": re.match(r"(?ms)^From (\S+) Mon Sep 17 00:00:00 2001$.+?^---$", diff).group(1),
+                "added_lines": added_lines.group(1) if added_lines else 0,
+                "deleted_lines": deleted_lines.group(1) if deleted_lines else 0,
+                "changed_files": changed_files.group(1) if changed_files else 0,
+                "files": list(re.findall(r"(?m)^diff --git \"?a/(.+)\"? \"?b/.+\"?$", diff)),
+            }
+        )
+    return sorted(changes, key=lambda change: change["sha"])
 
 
 def export_timelines(project, timelines):
-    pd.DataFrame(timelines).sort_values(["pull_number", "event_number"]).to_csv(
-        get_path("timelines", project), index=False, quoting=csv.QUOTE_ALL, escapechar="\\"
+    write_csv(
+        "timelines",
+        project,
+        sort_runs(timelines, ["pull_number", "event_number"]),
+        index=False,
+        quoting=csv.QUOTE_ALL,
+        escapechar="\\",
     )
 
 
+def export_actors(project, actors):
+    write_csv("actors", project, actors)
+
+
 def export_pulls(project, pulls):
-    pd.DataFrame(pulls).sort_values("number").to_csv(
-        get_path("pulls", project), index=False, quoting=csv.QUOTE_ALL, escapechar="\\"
+    write_csv(
+        "pulls", project, sort_runs(pd.DataFrame(pulls), "number"), index=False, quoting=csv.QUOTE_ALL, escapechar="\\"
     )
 
 
 def export_patches(project, patches):
-    pd.DataFrame(patches).sort_values(["pull_number", "sha"]).to_csv(
-        get_path("patches", project), index=False, quoting=csv.QUOTE_ALL
+    write_csv(
+        "patches", project, sort_runs(pd.DataFrame(patches), ["pull_number", "sha"]), index=False, quoting=csv.QUOTE_ALL
     )
 
 
-def preprocess_data(project):
+@instrument
+def preprocess_data(project, keep=False):
     logger = get_logger(__file__, modules={"sqlitedict": "WARNING"})
     logger.info(f"{project}: Preprocessing data")
-    timelines = open_timelines_raw(project)
-    pulls = open_pulls_raw(project)
-    commits = open_commits(project)
-    patches = open_patches_raw(project)
-    timelines = fix_timelines(project, timelines, pulls, commits)
-    export_timelines(project, filter_timelines(timelines))
-    export_pulls(project, filter_pulls(pulls))
-    export_patches(project, filter_patches(patches))
-    timelines.terminate()
+    pulls, patches = [], []
+    fixed = open_timelines_fixed(project) if keep else None
+    authors = lookup_authors(project)
+    events, actors = encode_timelines(
+        filter_timelines(fix_timelines(project, scan_pulls(project), pulls, patches, authors, fixed))
+    )
+    if fixed is not None:
+        fixed.close()
+    logger.info(f"{project}: Looked up commit authors with {authors.cache_info()}")
+    export_timelines(project, events)
+    export_actors(project, actors)
+    record_rows(rows_in=len(pulls), rows_out=len(events))
+    export_pulls(project, pulls)
+    export_patches(project, patches)
 
 
 def main():
+    get_logger(__file__)
     projects = []
     for project in toanalyze():
-        if cleanup_files(["timelines_fixed", "timelines", "pulls", "patches"], force_refresh(), project):
+        if cleanup_files(["timelines_fixed", "timelines", "actors", "pulls", "patches"], force_refresh(), project):
             projects.append(project)
         else:
             print(f"Skip preprocessing data for project {project}")
-    with joblib.Parallel(n_jobs=-1, verbose=1) as parallel:
-        parallel(joblib.delayed(preprocess_data)(project) for project in projects)
+    projects, predicted = schedule_projects(projects, "preprocess_data", joblib.cpu_count(), "timelines_raw")
+    start = time.perf_counter()
+    with joblib.Parallel(n_jobs=-1, batch_size=1, verbose=1) as parallel:
+        parallel(joblib.delayed(preprocess_data)(project, keep_fixed()) for project in projects)
+    report_schedule(predicted, start)
 
 
 if __name__ == "__main__":
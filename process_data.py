@@ -1,32 +1,64 @@
+import contextlib
+import csv
+
 import joblib
 import numpy as np
 import pandas as pd
 
 from common import (
+    ACTORS,
+    EVENTS,
+    CsvWriter,
+    apply_schema,
+    batch_projects,
     cleanup_files,
-    convert_dtypes,
     force_refresh,
     get_logger,
-    get_path,
     import_timelines,
     initialize,
+    instrument,
+    partition_size,
     preprocessed,
+    read_partitions,
+    record_rows,
+    serialize_csv,
 )
 
 initialize()
 
 
-def chunk_timelines(project):
-    groups = [group[1] for group in import_timelines(project).groupby("pull_number")]
-    for indices in np.array_split(np.arange(len(groups)), joblib.cpu_count()):
-        yield pd.concat([groups[index] for index in indices])
+def group_pulls(timelines, **kwargs):
+    return timelines.groupby(level=timelines.index.names[:-1], **kwargs)
+
+
+def load_timelines(projects):
+    frames = []
+    for project in projects:
+        if not (timelines := import_timelines(project)).index.is_monotonic_increasing:
+            timelines = timelines.sort_index()
+        frames.append(timelines)
+    if len(frames) == 1:
+        return frames[0]
+    return pd.concat(frames, keys=projects, names=["project"])
+
+
+def plan_chunks(timelines, chunks):
+    ends = group_pulls(timelines, sort=False).size().cumsum().to_numpy()
+    stops = np.unique(ends[np.searchsorted(ends, np.linspace(0, ends[-1], chunks + 1)[1:])])
+    return zip([0, *stops[:-1]], stops)
+
+
+def chunk_timelines(timelines, chunks=None):
+    if chunks is None:
+        chunks = 4 * joblib.cpu_count()
+    for start, stop in plan_chunks(timelines, chunks):
+        yield timelines.iloc[start:stop]
 
 
-@convert_dtypes
 def add_status(timelines):
     def find_status(timeline):
-        pulled = timeline.query("event == 'pulled'")
-        closed = timeline.query("event == 'closed'")
+        pulled = timeline.query("event == @EVENTS['pulled']")
+        closed = timeline.query("event == @EVENTS['closed']")
         timeline = timeline.assign(
             is_open=False,
             is_closed=False,
@@ -38,7 +70,7 @@ def add_status(timelines):
             merged_by=np.nan,
         )
         if pulled["state"].iat[0] == "closed":
-            if not (merged := timeline.query("event == 'merged'")).empty:
+            if not (merged := timeline.query("event == @EVENTS['merged']")).empty:
                 timeline["is_merged"] = True
                 timeline["merged_at"] = merged["time"].iat[0]
                 timeline["merged_by"] = merged["actor"].iat[0]
@@ -59,40 +91,42 @@ def add_status(timelines):
             timeline["is_open"] = True
         return timeline
 
-    timelines = timelines.groupby("pull_number", group_keys=False).apply(find_status)
+    timelines = group_pulls(timelines, group_keys=False).apply(find_status)
     timelines["resolved_at"] = timelines["merged_at"].fillna(timelines["closed_at"])
     timelines["resolved_by"] = timelines["merged_by"].fillna(timelines["closed_by"])
     return timelines.drop(columns=["state", "commit_id", "referenced"])
 
 
-@convert_dtypes
 def add_contributor(timelines):
     def find_contributor(timeline):
-        timeline["is_contributor"] = timeline["actor"] == timeline.query("event == 'pulled'")["actor"].iat[0]
+        timeline["is_contributor"] = timeline["actor"] == timeline.query("event == @EVENTS['pulled']")["actor"].iat[0]
         return timeline
 
-    return timelines.groupby("pull_number", group_keys=False).apply(find_contributor)
+    return group_pulls(timelines, group_keys=False).apply(find_contributor)
 
 
-@convert_dtypes
 def add_stale(timelines):
     def find_stale_action_closed(timeline):
-        if not (action_closed := timeline.query("event == 'closed' and actor == 'github-actions[bot]'")).empty:
+        if not (
+            action_closed := timeline.query("event == @EVENTS['closed'] and actor == @ACTORS['github-actions[bot]']")
+        ).empty:
             if not timeline.query("is_stale_action and time <= @action_closed['time'].iat[0]").empty:
                 timeline.loc[action_closed.index, "is_stale_action"] = True
         return timeline
 
-    timelines["is_stale_bot"] = timelines["actor"] == "stale[bot]"
-    timelines["is_stale_action"] = timelines["actor"].eq("github-actions[bot]") & (
-        (timelines["event"].eq("commented") & timelines["body"].str.contains("stale", case=False))
-        | (timelines["event"].isin(["labeled", "unlabeled"]) & timelines["label"].str.contains("stale", case=False))
+    timelines["is_stale_bot"] = timelines["actor"] == ACTORS["stale[bot]"]
+    timelines["is_stale_action"] = timelines["actor"].eq(ACTORS["github-actions[bot]"]) & (
+        (timelines["event"].eq(EVENTS["commented"]) & timelines["body"].str.contains("stale", case=False))
+        | (
+            timelines["event"].isin([EVENTS["labeled"], EVENTS["unlabeled"]])
+            & timelines["label"].str.contains("stale", case=False)
+        )
     )
-    timelines = timelines.groupby("pull_number", group_keys=False).apply(find_stale_action_closed)
+    timelines = group_pulls(timelines, group_keys=False).apply(find_stale_action_closed)
     timelines["is_stale"] = timelines["is_stale_bot"] | timelines["is_stale_action"]
     return timelines.drop(columns=["label", "body"])
 
 
-@convert_dtypes
 def add_staled(timelines):
     def find_staled(timeline):
         timeline = timeline.assign(is_staled=False, first_staled_at=pd.NaT, last_staled_at=pd.NaT)
@@ -102,20 +136,19 @@ def add_staled(timelines):
             timeline["last_staled_at"] = stale["time"].iat[-1]
         return timeline
 
-    return timelines.groupby("pull_number", group_keys=False).apply(find_staled)
+    return group_pulls(timelines, group_keys=False).apply(find_staled)
 
 
-@convert_dtypes
 def add_stale_closed(timelines):
     def find_stale_closed(timeline):
         timeline = timeline.assign(is_stale_closed=False, first_stale_closed_at=pd.NaT, last_stale_closed_at=pd.NaT)
-        if not (stale_closed := timeline.query("event == 'closed' and is_stale")).empty:
+        if not (stale_closed := timeline.query("event == @EVENTS['closed'] and is_stale")).empty:
             timeline["is_stale_closed"] = True
             timeline["first_stale_closed_at"] = stale_closed["time"].iat[0]
             timeline["last_stale_closed_at"] = stale_closed["time"].iat[-1]
         return timeline
 
-    return timelines.groupby("pull_number", group_keys=False).apply(find_stale_closed)
+    return group_pulls(timelines, group_keys=False).apply(find_stale_closed)
 
 
 def process_chunk(chunk):
@@ -124,18 +157,58 @@ def process_chunk(chunk):
     chunk = add_stale(chunk)
     chunk = add_staled(chunk)
     chunk = add_stale_closed(chunk)
-    return chunk
+    return apply_schema(chunk, "dataframe")
 
 
-def export_dataframe(project, chunks):
-    pd.concat(chunks).to_csv(get_path("dataframe", project))
+def serialize_chunk(chunk, projects):
+    dataframe = process_chunk(chunk)
+    if len(projects) == 1:
+        return len(dataframe), {projects[0]: serialize_csv(dataframe)}
+    return len(dataframe), {
+        project: serialize_csv(group.droplevel("project"))
+        for project, group in dataframe.groupby(level="project", sort=False)
+    }
 
 
-def process_data(project):
+@instrument
+def process_data(projects, parallel):
     logger = get_logger(__file__)
-    logger.info(f"{project}: Processing data")
-    with joblib.Parallel(n_jobs=-1, verbose=1) as parallel:
-        export_dataframe(project, parallel(joblib.delayed(process_chunk)(chunk) for chunk in chunk_timelines(project)))
+    for project in projects:
+        logger.info(f"{project}: Processing data")
+    timelines = load_timelines(projects)
+    rows = 0
+    with contextlib.ExitStack() as stack:
+        writers = {project: stack.enter_context(CsvWriter("dataframe", project)) for project in projects}
+        for chunk_rows, texts in parallel(
+            joblib.delayed(serialize_chunk)(chunk, projects) for chunk in chunk_timelines(timelines)
+        ):
+            rows += chunk_rows
+            for project, text in texts.items():
+                writers[project].write(text)
+    record_rows(rows_in=len(timelines), rows_out=rows)
+
+
+@instrument
+def process_partitions(project, parallel, size):
+    logger = get_logger(__file__)
+    logger.info(f"{project}: Processing data in partitions of {size} pull requests")
+    rows_in, rows_out = 0, 0
+    with CsvWriter("dataframe", project) as writer:
+        for timelines in read_partitions(
+            "timelines",
+            project,
+            size,
+            index_col=["pull_number", "event_number"],
+            quoting=csv.QUOTE_ALL,
+            escapechar="\\",
+        ):
+            for chunk_rows, texts in parallel(
+                joblib.delayed(serialize_chunk)(chunk, [project]) for chunk in chunk_timelines(timelines)
+            ):
+                rows_out += chunk_rows
+                writer.write(texts[project])
+            rows_in += len(timelines)
+    record_rows(rows_in=rows_in, rows_out=rows_out)
 
 
 def main():
@@ -145,8 +218,13 @@ def main():
             projects.append(project)
         else:
             print(f"Skip processing data for project {project}")
-    for project in projects:
-        process_data(project)
+    with joblib.Parallel(n_jobs=-1, return_as="generator", verbose=1) as parallel:
+        if size := partition_size():
+            for project in projects:
+                process_partitions(project, parallel, size)
+            return
+        for batch in batch_projects(projects, "timelines"):
+            process_data(batch, parallel)
 
 
 if __name__ == "__main__":
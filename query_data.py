@@ -0,0 +1,96 @@
+import argparse
+
+import duckdb
+
+from common import (
+    DATETIME,
+    SCHEMAS,
+    get_path,
+    indicated,
+    initialize,
+    measured,
+    postprocessed,
+)
+
+initialize()
+TABLES = {
+    "dataset": postprocessed,
+    "actors": postprocessed,
+    "features": measured,
+    "features_fixed": indicated,
+    "indicators": indicated,
+}
+TYPES = {
+    "int32": "INTEGER",
+    "Int32": "INTEGER",
+    "int64": "BIGINT",
+    "Int64": "BIGINT",
+    "float64": "DOUBLE",
+    "Float64": "DOUBLE",
+    "boolean": "BOOLEAN",
+    "string": "VARCHAR",
+    "category": "VARCHAR",
+    DATETIME: "TIMESTAMP",
+}
+
+
+def quote(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def scan_csv(table, project):
+    schema = SCHEMAS.get(table, {"actor_id": "int32", "actor": "string"})
+    types = ", ".join(f"{quote(column)}: {quote(TYPES[dtype])}" for column, dtype in schema.items())
+    source = f"read_csv({quote(get_path(table, project))}, header = true, types = {{{types}}})"
+    return f"SELECT * FROM {source}" if "project" in schema else f"SELECT {quote(project)} AS project, * FROM {source}"
+
+
+def panel_built(table, project):
+    partition = get_path(f"{table}_panel", project)
+    return partition.exists() and partition.stat().st_mtime >= get_path(table, project).stat().st_mtime
+
+
+def scan_table(table, projects):
+    built = [
+        project for project in projects if table in ["features_fixed", "indicators"] and panel_built(table, project)
+    ]
+    scans = [scan_csv(table, project) for project in projects if project not in built]
+    if built:
+        partitions = ", ".join(quote(get_path(f"{table}_panel", project)) for project in built)
+        scans.insert(0, f"SELECT * FROM read_parquet([{partitions}], union_by_name = true)")
+    return " UNION ALL BY NAME ".join(scans)
+
+
+def connect(projects=None, memory_limit="4GB"):
+    connection = duckdb.connect(config={"memory_limit": memory_limit, "temp_directory": str(get_path("spill"))})
+    for table, available in TABLES.items():
+        if selected := [project for project in available() if projects is None or project in projects]:
+            connection.execute(f"CREATE VIEW {table} AS {scan_table(table, selected)}")
+    return connection
+
+
+def query(sql, projects=None, memory_limit="4GB"):
+    with connect(projects, memory_limit) as connection:
+        return connection.execute(sql).df()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sql", help="query over the dataset, actors, features, features_fixed and indicators tables")
+    parser.add_argument("--projects", nargs="+", help="only scan these projects")
+    parser.add_argument("--memory-limit", default="4GB", help="memory used before spilling to disk")
+    parser.add_argument("--output", help="file to write the result to as CSV")
+    args = parser.parse_known_args()[0]
+    result = query(args.sql, args.projects, args.memory_limit)
+    if args.output is None:
+        print(result.to_string(index=False))
+    else:
+        result.to_csv(args.output, index=False)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("Stop querying data")
+        exit(1)